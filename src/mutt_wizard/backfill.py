@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict
+
+from mutt_wizard.config import Paths, write_json, write_text_atomic
+from mutt_wizard.locks import hold_lock
+from mutt_wizard.maildir import iter_folders, iter_messages
+
+BACKFILL_INTERVAL = 15 * 60.0
+# Syncs of different accounts update backfill.json and mbsyncrc concurrently.
+LOCK_NAME = "backfill"
+
+
+@dataclass
+class BackfillState:
+    limit: int
+    target: int
+    recent_boxes: list[str] = field(default_factory=list)
+    stage: str = "recent"
+    last_step: float = 0.0
+
+
+def load_backfill(paths: Paths) -> Dict[str, BackfillState]:
+    try:
+        data = json.loads(paths.backfill_state.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return {email: BackfillState(**value) for email, value in data.items()}
+
+
+def save_backfill(paths: Paths, states: Dict[str, BackfillState]) -> None:
+    write_json(
+        paths.backfill_state, {email: asdict(s) for email, s in states.items()}
+    )
+
+
+def start_backfill(
+    paths: Paths, email: str, initial: int, target: int, recent_boxes: list[str]
+) -> None:
+    with hold_lock(paths.locks_dir, LOCK_NAME):
+        states = load_backfill(paths)
+        states[email] = BackfillState(
+            limit=initial, target=target, recent_boxes=recent_boxes
+        )
+        save_backfill(paths, states)
+
+
+def clear_backfill(paths: Paths, email: str) -> None:
+    with hold_lock(paths.locks_dir, LOCK_NAME):
+        states = load_backfill(paths)
+        if states.pop(email, None) is not None:
+            save_backfill(paths, states)
+
+
+def set_max_messages(config_path: Path, channel: str, limit: int) -> None:
+    lines = config_path.read_text(encoding="utf-8").splitlines(keepends=True)
+    in_channel = False
+    for index, line in enumerate(lines):
+        if line.startswith("Channel "):
+            in_channel = line.split()[1:2] == [channel]
+        elif in_channel and line.startswith("MaxMessages "):
+            lines[index] = f"MaxMessages {limit}\n"
+            break
+    # mbsync runs for other accounts may read the file at any moment.
+    write_text_atomic(config_path, "".join(lines))
+
+
+def _next_limit(state: BackfillState) -> int:
+    limit = state.limit * 2
+    if state.target and limit >= state.target:
+        return state.target
+    return limit
+
+
+def _largest_folder(maildir: Path) -> int:
+    if not maildir.is_dir():
+        return 0
+    return max(
+        (sum(1 for _ in iter_messages(folder)) for folder in iter_folders(maildir)),
+        default=0,
+    )
+
+
+# Called before each sync of an account. Returns the mailboxes to restrict the
+# run to, or None for the whole channel. Raises the channel's MaxMessages once
+# per BACKFILL_INTERVAL until the configured depth is reached.
+def before_sync(
+    paths: Paths, email: str, now: float | None = None
+) -> list[str] | None:
+    with hold_lock(paths.locks_dir, LOCK_NAME):
+        states = load_backfill(paths)
+        state = states.get(email)
+        if state is None or state.stage == "done":
+            return None
+        if state.stage == "recent":
+            return state.recent_boxes or None
+        now = time.time() if now is None else now
+        if now - state.last_step >= BACKFILL_INTERVAL:
+            state.limit = _next_limit(state)
+            state.last_step = now
+            set_max_messages(paths.mbsync_config, email, state.limit)
+            save_backfill(paths, states)
+    return None
+
+
+def after_sync(
+    paths: Paths, email: str, success: bool, now: float | None = None
+) -> BackfillState | None:
+    with hold_lock(paths.locks_dir, LOCK_NAME):
+        states = load_backfill(paths)
+        state = states.get(email)
+        if state is None or state.stage == "done" or not success:
+            return state
+        now = time.time() if now is None else now
+        if state.stage == "recent":
+            state.stage = "backfill"
+            state.last_step = now
+        elif state.target and state.limit >= state.target:
+            state.stage = "done"
+        elif (
+            not state.target
+            and _largest_folder(paths.maildir_root / email) < state.limit
+        ):
+            # Every folder holds fewer messages than the limit, so nothing is
+            # cut off.
+            state.limit = 0
+            state.stage = "done"
+            set_max_messages(paths.mbsync_config, email, 0)
+        save_backfill(paths, states)
+    return state
+
+
+def describe_backfill(paths: Paths, email: str, state: BackfillState) -> str:
+    target = state.target or "all"
+    if state.stage == "done":
+        return f"{email}: complete (MaxMessages {state.target})"
+    if state.stage == "recent":
+        return (
+            f"{email}: waiting for first sync of {', '.join(state.recent_boxes)} "
+            f"({state.limit} messages per folder, target {target})"
+        )
+    local = _largest_folder(paths.maildir_root / email)
+    wait = max(0, int(state.last_step + BACKFILL_INTERVAL - time.time()))
+    return (
+        f"{email}: backfilling, {state.limit} messages per folder of {target} "
+        f"(largest local folder {local}), next step in {wait}s"
+    )
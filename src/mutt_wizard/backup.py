@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+from mutt_wizard.maildir import iter_folders, iter_messages, split_name
+
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_SUFFIX = ".tsv.gz"
+
+
+@dataclass
+class BackupStats:
+    files: int = 0
+    hashed: int = 0
+    stored: int = 0
+    stored_bytes: int = 0
+
+
+@dataclass
+class RestoreStats:
+    restored: int = 0
+    skipped: int = 0
+    missing: int = 0
+
+
+@dataclass
+class _Entry:
+    rel: str
+    path: str
+    size: int
+    mtime_ns: int
+    digest: str | None = None
+
+
+def object_path(store: Path, digest: str) -> Path:
+    return store / "objects" / digest[:2] / digest[2:]
+
+
+def _find_object(store: Path, digest: str) -> Path | None:
+    plain = object_path(store, digest)
+    for path in (plain, plain.with_name(plain.name + ".gz")):
+        if path.exists():
+            return path
+    return None
+
+
+def list_snapshots(store: Path) -> list[Path]:
+    return sorted((store / "manifests").glob(f"[!.]*{MANIFEST_SUFFIX}"))
+
+
+# One line per message: digest, size, mtime_ns and the path relative to the
+# mail root, which carries the account, folder, cur/new and the flags.
+def read_manifest(path: Path) -> Iterator[tuple[str, int, int, str]]:
+    with gzip.open(path, "rt", encoding="utf-8") as handle:
+        for line in handle:
+            digest, size, mtime_ns, rel = line.rstrip("\n").split("\t", 3)
+            yield digest, int(size), int(mtime_ns), rel
+
+
+def _key(rel: str) -> tuple[str, str]:
+    folder = os.path.dirname(os.path.dirname(rel))
+    return folder, split_name(os.path.basename(rel))[0]
+
+
+def _hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _store_object(source: str, store: Path, digest: str, compress: bool) -> int:
+    target = object_path(store, digest)
+    if compress:
+        target = target.with_name(target.name + ".gz")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{digest}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        with open(source, "rb") as src:
+            if compress:
+                with gzip.open(tmp, "wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            else:
+                with open(tmp, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp, target)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return target.stat().st_size
+
+
+def _backup_file(
+    entry: _Entry, store: Path, compress: bool, known: set[str]
+) -> tuple[str, int] | None:
+    try:
+        digest = _hash_file(entry.path)
+        if digest in known or _find_object(store, digest):
+            return digest, 0
+        return digest, _store_object(entry.path, store, digest, compress)
+    except FileNotFoundError:
+        # mbsync renamed or expunged the message since the scan.
+        return None
+
+
+def _scan(
+    root: Path, accounts: list[str], previous: dict[tuple[str, str], tuple]
+) -> list[_Entry]:
+    entries = []
+    for email in accounts:
+        account_root = root / email
+        if not account_root.is_dir():
+            continue
+        for folder in iter_folders(account_root):
+            for item in iter_messages(folder):
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                rel = os.path.relpath(item.path, root)
+                entry = _Entry(rel, item.path, stat.st_size, stat.st_mtime_ns)
+                known = previous.get(_key(rel))
+                if known and known[:2] == (entry.size, entry.mtime_ns):
+                    entry.digest = known[2]
+                entries.append(entry)
+    return entries
+
+
+# Messages whose folder, uid, size and mtime match the latest manifest reuse its
+# digest, so a run only reads files that are new or changed; of those, only
+# content missing from the store is copied. Accounts left out of a run keep
+# their entries from the latest manifest, so every manifest covers all of them.
+def backup(
+    root: Path,
+    store: Path,
+    accounts: list[str],
+    compress: bool = False,
+    jobs: int = 0,
+) -> tuple[Path, BackupStats]:
+    previous: dict[tuple[str, str], tuple] = {}
+    known: set[str] = set()
+    carried: list[_Entry] = []
+    selected = set(accounts)
+    snapshots = list_snapshots(store)
+    if snapshots:
+        for digest, size, mtime_ns, rel in read_manifest(snapshots[-1]):
+            known.add(digest)
+            if rel.split("/", 1)[0] not in selected:
+                carried.append(_Entry(rel, "", size, mtime_ns, digest))
+                continue
+            previous[_key(rel)] = (size, mtime_ns, digest)
+
+    stats = BackupStats()
+    entries = _scan(root, accounts, previous)
+    todo = [entry for entry in entries if entry.digest is None]
+    workers = jobs or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            lambda entry: _backup_file(entry, store, compress, known), todo
+        )
+        for entry, result in zip(todo, results):
+            if result is None:
+                continue
+            entry.digest, written = result
+            stats.hashed += 1
+            if written:
+                stats.stored += 1
+                stats.stored_bytes += written
+
+    manifests = store / "manifests"
+    manifests.mkdir(parents=True, exist_ok=True)
+    manifest = manifests / (time.strftime("%Y%m%dT%H%M%S") + MANIFEST_SUFFIX)
+    tmp = manifest.with_name(f".{manifest.name}.tmp")
+    with gzip.open(tmp, "wt", encoding="utf-8") as handle:
+        for entry in sorted(entries + carried, key=lambda entry: entry.rel):
+            if entry.digest is None:
+                continue
+            handle.write(
+                f"{entry.digest}\t{entry.size}\t{entry.mtime_ns}\t{entry.rel}\n"
+            )
+            stats.files += 1
+    os.replace(tmp, manifest)
+    return manifest, stats
+
+
+def _folder_uids(folder: Path) -> set[str]:
+    return {split_name(entry.name)[0] for entry in iter_messages(folder)}
+
+
+# Streams the manifest and each object in chunks, delivering through the
+# folder's tmp/ like any maildir writer. Messages already present under the
+# same uid are left alone.
+def restore(
+    store: Path, manifest: Path, root: Path, accounts: list[str]
+) -> RestoreStats:
+    stats = RestoreStats()
+    present: dict[Path, set[str]] = {}
+    for digest, _, mtime_ns, rel in read_manifest(manifest):
+        if accounts and rel.split("/", 1)[0] not in accounts:
+            continue
+        target = root / rel
+        folder = target.parent.parent
+        uid = split_name(target.name)[0]
+        uids = present.get(folder)
+        if uids is None:
+            uids = present[folder] = _folder_uids(folder)
+        if uid in uids:
+            stats.skipped += 1
+            continue
+        source = _find_object(store, digest)
+        if source is None:
+            stats.missing += 1
+            continue
+        for sub in ("cur", "new", "tmp"):
+            (folder / sub).mkdir(parents=True, exist_ok=True)
+        tmp = folder / "tmp" / f"{uid}.mwrestore"
+        opener = gzip.open if source.suffix == ".gz" else open
+        with opener(source, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp, target)
+        uids.add(uid)
+        stats.restored += 1
+    return stats
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import json
+import socket
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict
+
+from mutt_wizard.config import write_json
+
+PROBE_TIMEOUT = 2.0
+RETRY_BASE = 60.0
+RETRY_MAX = 30 * 60.0
+
+
+@dataclass
+class HostState:
+    failures: int = 0
+    retry_at: float = 0.0
+
+
+def load_state(path: Path) -> Dict[str, HostState]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return {key: HostState(**value) for key, value in data.items()}
+
+
+def save_state(path: Path, states: Dict[str, HostState]) -> None:
+    write_json(path, {key: asdict(state) for key, state in states.items()})
+
+
+def _probe(host: str, port: int, results: Dict[str, bool], key: str) -> None:
+    try:
+        with socket.create_connection((host, port), timeout=PROBE_TIMEOUT):
+            results[key] = True
+    except OSError:
+        results[key] = False
+
+
+# With probe_open, hosts still waiting out their retry period are probed as
+# well: a run the user started is the half-open trial, not skipped.
+def check_hosts(
+    hosts: list[tuple[str, int]],
+    states: Dict[str, HostState],
+    now: float | None = None,
+    probe_open: bool = False,
+) -> Dict[str, bool]:
+    now = time.time() if now is None else now
+    results: Dict[str, bool] = {}
+    threads = []
+    for host, port in set(hosts):
+        key = f"{host}:{port}"
+        state = states.get(key)
+        if state and state.retry_at > now and not probe_open:
+            results[key] = False
+            continue
+        # Probes run in daemon threads so a hung DNS lookup cannot delay exit.
+        thread = threading.Thread(
+            target=_probe, args=(host, port, results, key), daemon=True
+        )
+        thread.start()
+        threads.append((key, thread))
+
+    deadline = time.monotonic() + PROBE_TIMEOUT + 0.5
+    for key, thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+        if results.setdefault(key, False):
+            states.pop(key, None)
+            continue
+        state = states.setdefault(key, HostState())
+        state.failures += 1
+        state.retry_at = now + min(RETRY_BASE * 2 ** (state.failures - 1), RETRY_MAX)
+    return results
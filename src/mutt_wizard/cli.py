@@ -1,20 +1,59 @@
 from __future__ import annotations
 
 import argparse
+import os
+import re
 import shutil
+import sqlite3
 import sys
+import time
+from email.parser import BytesParser
+from email.policy import compat32
+from email.utils import getaddresses
 from pathlib import Path
 
+from mutt_wizard.backfill import (
+    clear_backfill,
+    describe_backfill,
+    load_backfill,
+    start_backfill,
+)
+from mutt_wizard.backup import backup, list_snapshots, restore
 from mutt_wizard.config import (
     Account,
+    account_from_dict,
     default_sasl_path,
     ensure_dirs,
     get_paths,
     load_accounts,
+    read_env_file,
     save_accounts,
     ssl_cert_path,
+    write_env_value,
+)
+from mutt_wizard.contacts import open_contacts, query_contacts, update_contacts
+from mutt_wizard.dedupe import LOCK_NAME as DEDUPE_LOCK
+from mutt_wizard.dedupe import dedupe_account, format_size, open_db
+from mutt_wizard.locks import hold_lock
+from mutt_wizard.oversized import fetch_oversized, load_oversized
+from mutt_wizard.search import link_results, open_index, search, update_index
+from mutt_wizard.sendq import (
+    enqueue,
+    failed,
+    queued,
+    queued_accounts,
+    retry_failed,
+    run_flusher,
+    spawn_flusher,
+)
+from mutt_wizard.survey import (
+    format_duration,
+    load_survey,
+    plan_lanes,
+    save_survey,
+    survey,
+    transfer_seconds,
 )
-from mutt_wizard.oauth import access_token, ensure_token
 from mutt_wizard.templates import (
     OPENFILE_SH,
     SWITCH_MUTTRC,
@@ -45,7 +84,7 @@ def _ensure_base_files(paths) -> None:
                 sasl_path = candidate
                 break
     if sasl_path:
-        _write_file(paths.env_file, f"SASL_PATH={sasl_path}\n")
+        write_env_value(paths, "SASL_PATH", sasl_path)
 
 
 def _ensure_main_muttrc(paths) -> None:
@@ -158,6 +197,8 @@ def _store_account(paths, account: Account) -> None:
         "auth_method": account.auth_method,
         "pass_prefix": account.pass_prefix,
         "client_secret": account.client_secret,
+        "send_queue": account.send_queue,
+        "max_size": account.max_size,
     }
     save_accounts(paths, accounts)
 
@@ -168,11 +209,17 @@ def _copy_client_secret(paths, email: str, client_secret: Path) -> Path:
     return dest
 
 
+def _recent_mailboxes(account: Account) -> list[str]:
+    sent = "[Gmail]/Sent Mail" if account.is_gmail else "Sent"
+    return [box for box in mailboxes_for_account(account) if box in ("INBOX", sent)]
+
+
 def _setup_account(
     account: Account,
     client_secret: Path | None,
     open_browser: bool,
     max_messages: int,
+    initial_messages: int = 0,
 ) -> None:
     paths = get_paths()
     ensure_dirs(paths)
@@ -181,6 +228,9 @@ def _setup_account(
     sslcert = ssl_cert_path()
 
     if account.is_gmail and account.auth_method == "oauth":
+        # Imported here so commands such as the contacts query start quickly.
+        from mutt_wizard.oauth import ensure_token
+
         if not client_secret:
             raise SystemExit("--client-secrets is required for Gmail OAuth")
         stored_secret = _copy_client_secret(paths, account.email, client_secret)
@@ -192,14 +242,37 @@ def _setup_account(
     _ensure_account_muttrc(paths, account, account_id)
     _ensure_maildir(paths, account)
     _ensure_msmtp(paths, account, sslcert)
-    _ensure_mbsync(paths, account, sslcert, max_messages)
+    staged = initial_messages > 0 and (
+        not max_messages or initial_messages < max_messages
+    )
+    _ensure_mbsync(
+        paths, account, sslcert, initial_messages if staged else max_messages
+    )
     _store_account(paths, account)
+    if staged:
+        start_backfill(
+            paths,
+            account.email,
+            initial_messages,
+            max_messages,
+            _recent_mailboxes(account),
+        )
+    else:
+        # A leftover entry from an earlier setup would cap this account.
+        clear_backfill(paths, account.email)
 
     print(f"Configured {account.email} (account #{account_id}).")
+    if staged:
+        print(
+            f"Run mailsync to fetch the newest {initial_messages} messages first; "
+            "later runs backfill older mail (see mw backfill)."
+        )
 
 
 def _cmd_add(args: argparse.Namespace) -> None:
     email = args.email
+    if args.max_size and not re.fullmatch(r"\d+[kKmM]?[bB]?", args.max_size):
+        raise SystemExit("--max-size must look like 500k or 10m")
     login = args.login or email
     realname = args.realname or email.split("@", 1)[0]
 
@@ -214,11 +287,19 @@ def _cmd_add(args: argparse.Namespace) -> None:
             smtp_port=args.smtp_port,
             is_gmail=True,
             auth_method="oauth",
+            send_queue=args.send_queue,
+            max_size=args.max_size,
         )
         client_secret = (
             Path(args.client_secrets).expanduser() if args.client_secrets else None
         )
-        _setup_account(account, client_secret, not args.no_browser, args.max_messages)
+        _setup_account(
+            account,
+            client_secret,
+            not args.no_browser,
+            args.max_messages,
+            args.initial_messages,
+        )
         return
 
     if args.gmail:
@@ -233,8 +314,12 @@ def _cmd_add(args: argparse.Namespace) -> None:
             is_gmail=True,
             auth_method="pass",
             pass_prefix=args.pass_prefix or "",
+            send_queue=args.send_queue,
+            max_size=args.max_size,
+        )
+        _setup_account(
+            account, None, True, args.max_messages, args.initial_messages
         )
-        _setup_account(account, None, True, args.max_messages)
         return
 
     if not args.imap or not args.smtp:
@@ -250,8 +335,10 @@ def _cmd_add(args: argparse.Namespace) -> None:
         smtp_port=args.smtp_port,
         is_gmail=False,
         pass_prefix=args.pass_prefix or "",
+        send_queue=args.send_queue,
+        max_size=args.max_size,
     )
-    _setup_account(account, None, True, args.max_messages)
+    _setup_account(account, None, True, args.max_messages, args.initial_messages)
 
 
 def _cmd_list(args: argparse.Namespace) -> None:
@@ -262,6 +349,8 @@ def _cmd_list(args: argparse.Namespace) -> None:
 
 
 def _cmd_oauth_login(args: argparse.Namespace) -> None:
+    from mutt_wizard.oauth import ensure_token
+
     paths = get_paths()
     accounts = load_accounts(paths)
     account = accounts.get(args.email)
@@ -276,6 +365,8 @@ def _cmd_oauth_login(args: argparse.Namespace) -> None:
 
 
 def _cmd_oauth_token(args: argparse.Namespace) -> None:
+    from mutt_wizard.oauth import access_token
+
     paths = get_paths()
     accounts = load_accounts(paths)
     account = accounts.get(args.email)
@@ -289,6 +380,279 @@ def _cmd_oauth_token(args: argparse.Namespace) -> None:
     print(token)
 
 
+def _cmd_search(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    query = " ".join(args.query)
+    if args.prompt:
+        query = input("Search mail: ").strip()
+    try:
+        conn = open_index(paths.search_index)
+    except RuntimeError as exc:
+        raise SystemExit(str(exc))
+    try:
+        if args.update or not conn.execute("SELECT 1 FROM folders").fetchone():
+            stats = update_index(conn, paths.maildir_root)
+            print(
+                f"Indexed {stats.added} new, {stats.moved} renamed, "
+                f"{stats.removed} removed message(s).",
+                file=sys.stderr,
+            )
+        results = []
+        if query:
+            results = search(conn, paths.maildir_root, query, args.account, args.limit)
+    except sqlite3.OperationalError as exc:
+        raise SystemExit(f"Invalid search query: {exc}")
+    finally:
+        conn.close()
+    if args.link:
+        link_results(results, paths.search_results)
+        print(f"{len(results)} result(s) in {paths.search_results}")
+        return
+    for path in results:
+        print(path)
+
+
+def _cmd_contacts(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    if args.rebuild:
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{paths.contacts_index}{suffix}").unlink(missing_ok=True)
+    elif not args.update and not paths.contacts_index.exists():
+        print("0 contact(s)")
+        print("No contacts index; run mw contacts --update", file=sys.stderr)
+        return
+    conn = open_contacts(paths.contacts_index)
+    try:
+        if args.update or args.rebuild:
+            stats = update_contacts(
+                conn, paths.maildir_root, set(load_accounts(paths))
+            )
+            print(
+                f"Read {stats.messages} message(s): {stats.added} new, "
+                f"{stats.updated} updated, {stats.pruned} pruned contact(s)"
+            )
+            return
+        results = query_contacts(conn, " ".join(args.query), args.limit)
+    finally:
+        conn.close()
+    # neomutt's query_command skips the first line of output.
+    print(f"{len(results)} contact(s)")
+    for address, name, sent, received in results:
+        print(f"{address}\t{name}\tsent {sent}, received {received}")
+
+
+def _cmd_dedupe(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    emails = args.accounts or sorted(load_accounts(paths))
+    conn = open_db(paths.dedupe_index)
+    try:
+        for email in emails:
+            # The account lock keeps mbsync from renaming files under _link.
+            with hold_lock(paths.locks_dir, email):
+                with hold_lock(paths.locks_dir, DEDUPE_LOCK):
+                    stats = dedupe_account(conn, paths.maildir_root, email)
+            print(
+                f"{email}: scanned {stats.scanned}, linked {stats.linked}, "
+                f"reclaimed {format_size(stats.reclaimed)}"
+            )
+    finally:
+        conn.close()
+
+
+def _sendq_status(paths, accounts) -> None:
+    now = time.time()
+    emails = sorted(set(queued_accounts(paths)) | set(accounts))
+    for email in emails:
+        pending = queued(paths, email)
+        dead = failed(paths, email)
+        if not pending and not dead:
+            continue
+        line = f"{email}: {len(pending)} queued, {len(dead)} failed"
+        if pending:
+            wait = max(0, int(min(m.next_try for m in pending) - now))
+            line += f" (next attempt in {wait}s)"
+        print(line)
+        for message in pending:
+            if message.error:
+                print(f"  retrying {message.id}: {message.error}")
+        for message in dead:
+            print(f"  failed {message.id} to {', '.join(message.recipients)}")
+            print(f"    {message.error}")
+
+
+def _cmd_sendq(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    accounts = {
+        email: account_from_dict(data) for email, data in load_accounts(paths).items()
+    }
+    if args.status:
+        _sendq_status(paths, accounts)
+        return
+    if args.retry:
+        for email in accounts:
+            count = retry_failed(paths, email)
+            if count:
+                print(f"{email}: requeued {count} message(s)")
+        spawn_flusher(paths)
+        return
+    if args.flush:
+        run_flusher(paths, accounts)
+        return
+
+    email = args.account
+    if not email and args.sender in accounts:
+        email = args.sender
+    if email not in accounts:
+        raise SystemExit(f"sendq: unknown account {email!r}; pass -a <email>")
+    data = sys.stdin.buffer.read()
+    recipients = list(args.recipients)
+    if args.read_recipients:
+        message = BytesParser(policy=compat32).parsebytes(data)
+        headers = [
+            value
+            for name in ("To", "Cc", "Bcc")
+            for value in message.get_all(name, [])
+        ]
+        recipients += [addr for _, addr in getaddresses(headers) if addr]
+        if "Bcc" in message:
+            del message["Bcc"]
+            data = message.as_bytes()
+    if not recipients:
+        raise SystemExit("sendq: no recipients")
+    enqueue(paths, email, args.sender or email, recipients, data)
+    spawn_flusher(paths)
+
+
+def _cmd_backfill(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    states = load_backfill(paths)
+    if not states:
+        print("No staged syncs.")
+        return
+    for email, state in sorted(states.items()):
+        print(describe_backfill(paths, email, state))
+
+
+def _cmd_fetch(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    accounts = load_accounts(paths)
+    if args.list:
+        recorded = load_oversized(paths)
+        for email in [args.email] if args.email else sorted(recorded):
+            for message in recorded.get(email, {}).get("messages", []):
+                print(f"{email}\t{message['folder']}\t{message['subject']}")
+        return
+    if not args.email:
+        raise SystemExit("fetch: an account is required")
+    if args.email not in accounts:
+        raise SystemExit("Account not found in accounts.json")
+    env = {**os.environ, **read_env_file(paths)}
+    code = fetch_oversized(paths, args.email, args.folder, env)
+    if code:
+        raise SystemExit(code)
+
+
+def _cmd_backup(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    store = Path(args.dest).expanduser() if args.dest else paths.backup_dir
+    snapshots = list_snapshots(store)
+    if args.list:
+        for snapshot in snapshots:
+            print(snapshot.name)
+        return
+    if args.restore:
+        if args.restore == "latest":
+            if not snapshots:
+                raise SystemExit(f"backup: no snapshots in {store}")
+            manifest = snapshots[-1]
+        else:
+            manifest = Path(args.restore).expanduser()
+            if not manifest.exists():
+                manifest = store / "manifests" / args.restore
+        if not manifest.exists():
+            raise SystemExit(f"backup: snapshot {args.restore!r} not found")
+        target = Path(args.to).expanduser() if args.to else paths.maildir_root
+        stats = restore(store, manifest, target, args.accounts)
+        print(
+            f"Restored {stats.restored} message(s) from {manifest.name} to "
+            f"{target}; {stats.skipped} already present, {stats.missing} missing"
+        )
+        return
+
+    emails = args.accounts or sorted(load_accounts(paths))
+    manifest, stats = backup(
+        paths.maildir_root, store, emails, compress=args.compress, jobs=args.jobs
+    )
+    print(
+        f"{manifest.name}: {stats.files} message(s), {stats.hashed} hashed, "
+        f"{stats.stored} new ({format_size(stats.stored_bytes)}) in {store}"
+    )
+
+
+def _cmd_survey(args: argparse.Namespace) -> None:
+    paths = get_paths()
+    accounts = load_accounts(paths)
+    emails = args.accounts or sorted(accounts)
+    for email in emails:
+        if email not in accounts:
+            raise SystemExit(f"survey: unknown account {email!r}")
+    if args.cached:
+        cached = {item.email: item for item in load_survey(paths)}
+        results = [cached[email] for email in emails if email in cached]
+        if not results:
+            raise SystemExit("survey: nothing cached yet; run mw survey first")
+    else:
+        results = survey(paths, [account_from_dict(accounts[e]) for e in emails])
+        save_survey(paths, results)
+
+    now = time.time()
+    ok = []
+    for item in results:
+        if item.error:
+            print(f"{item.email}: survey failed: {item.error}")
+            continue
+        ok.append(item)
+        seconds = transfer_seconds(item.size, args.bandwidth)
+        approx = "~" if item.size_is_estimate else ""
+        unseen = sum(folder.unseen for folder in item.synced_folders)
+        line = (
+            f"{item.email}: {len(item.synced_folders)} folders, "
+            f"{item.messages} messages ({unseen} unseen), "
+            f"{approx}{format_size(item.size)}, ~{format_duration(seconds)}"
+        )
+        if args.cached:
+            line += f" (surveyed {format_duration(now - item.surveyed_at)} ago)"
+        print(line)
+        if args.folders:
+            for folder in sorted(item.folders, key=lambda f: f.name):
+                skipped = "" if folder.synced else " (not synced)"
+                print(
+                    f"  {folder.name}: {folder.messages} messages, "
+                    f"{folder.unseen} unseen, "
+                    f"{format_size(folder.estimated_size)}{skipped}"
+                )
+        local = paths.maildir_root / item.email
+        first_sync = not any(local.glob("*/cur/*"))
+        if first_sync and seconds > 3600:
+            print(
+                "  first sync will be long; consider re-adding with "
+                "--initial-messages to fetch recent mail first"
+            )
+    if not ok:
+        return
+
+    lanes = plan_lanes(ok, args.jobs or min(4, len(ok)))
+    longest = max(sum(item.size for item in lane) for lane in lanes)
+    total = sum(item.size for item in ok)
+    print(
+        f"Total {format_size(total)}; {len(lanes)} parallel mailsync run(s) "
+        f"finish in ~{format_duration(transfer_seconds(longest, args.bandwidth))} "
+        f"at {args.bandwidth:g} Mbit/s per connection:"
+    )
+    for lane in lanes:
+        print("  mailsync " + " ".join(item.email for item in lane))
+
+
 def _filter_muttrc(muttrc_path: Path, paths, emails: set[str]) -> None:
     if not muttrc_path.exists():
         return
@@ -342,6 +706,10 @@ def _cmd_reset(args: argparse.Namespace) -> None:
     if paths.cache_dir.exists():
         shutil.rmtree(paths.cache_dir)
 
+    # Sync state, locks, the sendq log and mbsyncrc.fetch (which holds PassCmd).
+    if paths.state_dir.exists():
+        shutil.rmtree(paths.state_dir)
+
     if paths.msmtp_log.exists():
         paths.msmtp_log.unlink()
 
@@ -371,7 +739,24 @@ def main(argv: list[str] | None = None) -> int:
     add.add_argument("--smtp-port", type=int, default=587)
     add.add_argument("--pass-prefix", default="")
     add.add_argument("--max-messages", type=int, default=0)
+    add.add_argument(
+        "--initial-messages",
+        type=int,
+        default=0,
+        help="Sync only this many recent messages of INBOX and Sent first, "
+        "then backfill up to --max-messages",
+    )
     add.add_argument("--no-browser", action="store_true")
+    add.add_argument(
+        "--max-size",
+        default="",
+        help="Skip messages larger than this (e.g. 10m); fetch them with mw fetch",
+    )
+    add.add_argument(
+        "--send-queue",
+        action="store_true",
+        help="Send through the mw sendq background queue instead of msmtp",
+    )
     add.set_defaults(func=_cmd_add)
 
     list_cmd = sub.add_parser("list", help="List configured accounts")
@@ -389,6 +774,128 @@ def main(argv: list[str] | None = None) -> int:
     oauth_token_cmd.add_argument("email")
     oauth_token_cmd.set_defaults(func=_cmd_oauth_token)
 
+    search_cmd = sub.add_parser("search", help="Search the local mail index")
+    search_cmd.add_argument("query", nargs="*", help="FTS5 query, e.g. sender:alice")
+    search_cmd.add_argument("--account", help="Only search this account")
+    search_cmd.add_argument("--limit", type=int, default=200)
+    search_cmd.add_argument(
+        "--update", action="store_true", help="Update the index before searching"
+    )
+    search_cmd.add_argument(
+        "--link",
+        action="store_true",
+        help="Link results into a maildir neomutt can open",
+    )
+    search_cmd.add_argument(
+        "--prompt", action="store_true", help="Read the query from the terminal"
+    )
+    search_cmd.set_defaults(func=_cmd_search)
+
+    contacts = sub.add_parser(
+        "contacts", help="Query the address book built from synced mail"
+    )
+    contacts.add_argument("query", nargs="*")
+    contacts.add_argument("--limit", type=int, default=30)
+    contacts.add_argument(
+        "--update", action="store_true", help="Read new messages into the index"
+    )
+    contacts.add_argument(
+        "--rebuild", action="store_true", help="Rebuild the index from scratch"
+    )
+    contacts.set_defaults(func=_cmd_contacts)
+
+    dedupe = sub.add_parser(
+        "dedupe", help="Hardlink identical messages across an account's folders"
+    )
+    dedupe.add_argument("accounts", nargs="*")
+    dedupe.set_defaults(func=_cmd_dedupe)
+
+    sendq = sub.add_parser(
+        "sendq", help="Queue outgoing mail (sendmail-compatible) and send it"
+    )
+    sendq.add_argument("-a", dest="account", help="Account to send from")
+    sendq.add_argument("-f", dest="sender", help="Envelope sender")
+    sendq.add_argument(
+        "-t",
+        dest="read_recipients",
+        action="store_true",
+        help="Read recipients from the message headers",
+    )
+    # Accepted for sendmail compatibility and ignored.
+    sendq.add_argument("-i", action="store_true", help=argparse.SUPPRESS)
+    for flag in ("-o", "-B", "-F", "-N", "-R", "-V"):
+        sendq.add_argument(flag, action="append", help=argparse.SUPPRESS)
+    sendq.add_argument("--flush", action="store_true", help="Send queued mail now")
+    sendq.add_argument(
+        "--status", action="store_true", help="Show queued and failed mail"
+    )
+    sendq.add_argument(
+        "--retry", action="store_true", help="Requeue failed mail and send it"
+    )
+    sendq.add_argument("recipients", nargs="*")
+    sendq.set_defaults(func=_cmd_sendq)
+
+    fetch = sub.add_parser("fetch", help="Download messages skipped by --max-size")
+    fetch.add_argument("email", nargs="?")
+    fetch.add_argument(
+        "--folder",
+        action="append",
+        default=[],
+        help="Fetch every oversized message in this folder (repeatable)",
+    )
+    fetch.add_argument(
+        "--list", action="store_true", help="List recorded oversized messages"
+    )
+    fetch.set_defaults(func=_cmd_fetch)
+
+    backfill = sub.add_parser("backfill", help="Show staged initial sync progress")
+    backfill.set_defaults(func=_cmd_backfill)
+
+    backup_cmd = sub.add_parser("backup", help="Back up or restore local mail")
+    backup_cmd.add_argument("accounts", nargs="*")
+    backup_cmd.add_argument(
+        "--dest", help="Backup store (default ~/.local/share/mutt-wizard/backup)"
+    )
+    backup_cmd.add_argument(
+        "--compress", action="store_true", help="Store new messages gzipped"
+    )
+    backup_cmd.add_argument(
+        "--jobs", type=int, default=0, help="Hashing threads (default: CPUs, max 8)"
+    )
+    backup_cmd.add_argument("--list", action="store_true", help="List snapshots")
+    backup_cmd.add_argument(
+        "--restore",
+        nargs="?",
+        const="latest",
+        metavar="SNAPSHOT",
+        help="Restore a snapshot (default: the latest)",
+    )
+    backup_cmd.add_argument(
+        "--to", help="Mail root to restore into (default ~/.local/share/mail)"
+    )
+    backup_cmd.set_defaults(func=_cmd_backup)
+
+    survey_cmd = sub.add_parser(
+        "survey", help="Count remote mail and plan the sync before running it"
+    )
+    survey_cmd.add_argument("accounts", nargs="*")
+    survey_cmd.add_argument(
+        "--bandwidth",
+        type=float,
+        default=20.0,
+        help="Expected throughput per IMAP connection in Mbit/s (default 20)",
+    )
+    survey_cmd.add_argument(
+        "--jobs", type=int, default=0, help="Parallel mailsync runs to plan for"
+    )
+    survey_cmd.add_argument(
+        "--cached", action="store_true", help="Report the last survey, offline"
+    )
+    survey_cmd.add_argument(
+        "--folders", action="store_true", help="Show per-folder counts"
+    )
+    survey_cmd.set_defaults(func=_cmd_survey)
+
     reset = sub.add_parser("reset", help="Remove mutt-wizard config and entries")
     reset.add_argument("--yes", action="store_true", help="Skip confirmation prompt")
     reset.set_defaults(func=_cmd_reset)
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import os
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Dict
@@ -33,6 +34,20 @@ class Paths:
     cache_dir: Path
     accounts_file: Path
     env_file: Path
+    tag_rules: Path
+    search_index: Path
+    search_results: Path
+    dedupe_index: Path
+    state_dir: Path
+    locks_dir: Path
+    circuit_state: Path
+    outbox: Path
+    sendq_log: Path
+    backfill_state: Path
+    oversized_state: Path
+    survey_cache: Path
+    backup_dir: Path
+    contacts_index: Path
 
 
 @dataclass
@@ -48,6 +63,8 @@ class Account:
     auth_method: str = "oauth"
     pass_prefix: str = ""
     client_secret: str | None = None
+    send_queue: bool = False
+    max_size: str = ""
 
 
 def get_paths() -> Paths:
@@ -72,6 +89,20 @@ def get_paths() -> Paths:
     cache_dir = cache_home / "mutt-wizard"
     accounts_file = app_config / "accounts.json"
     env_file = app_config / "env"
+    tag_rules = app_config / "tag-rules"
+    search_index = cache_dir / "search.sqlite"
+    search_results = cache_dir / "search-results"
+    dedupe_index = cache_dir / "dedupe.sqlite"
+    state_dir = state_home / "mutt-wizard"
+    locks_dir = state_dir / "locks"
+    circuit_state = state_dir / "circuits.json"
+    outbox = data_home / "mutt-wizard" / "outbox"
+    sendq_log = state_dir / "sendq.log"
+    backfill_state = state_dir / "backfill.json"
+    oversized_state = state_dir / "oversized.json"
+    survey_cache = cache_dir / "survey.json"
+    backup_dir = data_home / "mutt-wizard" / "backup"
+    contacts_index = cache_dir / "contacts.sqlite"
 
     return Paths(
         config_home=config_home,
@@ -94,6 +125,20 @@ def get_paths() -> Paths:
         cache_dir=cache_dir,
         accounts_file=accounts_file,
         env_file=env_file,
+        tag_rules=tag_rules,
+        search_index=search_index,
+        search_results=search_results,
+        dedupe_index=dedupe_index,
+        state_dir=state_dir,
+        locks_dir=locks_dir,
+        circuit_state=circuit_state,
+        outbox=outbox,
+        sendq_log=sendq_log,
+        backfill_state=backfill_state,
+        oversized_state=oversized_state,
+        survey_cache=survey_cache,
+        backup_dir=backup_dir,
+        contacts_index=contacts_index,
     )
 
 
@@ -109,6 +154,7 @@ def ensure_dirs(paths: Paths) -> None:
         paths.clients_dir,
         paths.cache_dir,
         paths.msmtp_log.parent,
+        paths.locks_dir,
     ]:
         path.mkdir(parents=True, exist_ok=True)
 
@@ -146,6 +192,55 @@ def default_sasl_path() -> str | None:
     return None
 
 
+def read_env_file(paths: Paths) -> Dict[str, str]:
+    env: Dict[str, str] = {}
+    if not paths.env_file.exists():
+        return env
+    for line in paths.env_file.read_text(encoding="utf-8").splitlines():
+        if not line.strip() or line.strip().startswith("#"):
+            continue
+        if "=" in line:
+            key, value = line.split("=", 1)
+            env[key.strip()] = value.strip()
+    return env
+
+
+# Writes through a uniquely named temp file so concurrent writers never share
+# one and readers see either the old or the new content; the last os.replace
+# wins. An existing file keeps its permissions, a new one is private.
+def write_text_atomic(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            handle.write(text)
+        try:
+            os.chmod(tmp, path.stat().st_mode & 0o777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_json(path: Path, data: Any) -> None:
+    write_text_atomic(path, json.dumps(data, indent=2))
+
+
+def write_env_value(paths: Paths, key: str, value: str) -> None:
+    lines = []
+    if paths.env_file.exists():
+        lines = [
+            line
+            for line in paths.env_file.read_text(encoding="utf-8").splitlines()
+            if line.partition("=")[0].strip() != key
+        ]
+    lines.append(f"{key}={value}")
+    paths.env_file.parent.mkdir(parents=True, exist_ok=True)
+    paths.env_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
 def load_accounts(paths: Paths) -> Dict[str, Dict[str, Any]]:
     if not paths.accounts_file.exists():
         return {}
@@ -172,4 +267,24 @@ def account_to_dict(account: Account) -> Dict[str, Any]:
         "auth_method": account.auth_method,
         "pass_prefix": account.pass_prefix,
         "client_secret": account.client_secret,
+        "send_queue": account.send_queue,
+        "max_size": account.max_size,
     }
+
+
+def account_from_dict(data: Dict[str, Any]) -> Account:
+    return Account(
+        email=data["email"],
+        login=data.get("login") or data["email"],
+        realname=data.get("realname") or "",
+        imap_host=data["imap_host"],
+        imap_port=int(data.get("imap_port") or 993),
+        smtp_host=data["smtp_host"],
+        smtp_port=int(data.get("smtp_port") or 587),
+        is_gmail=bool(data.get("is_gmail")),
+        auth_method=data.get("auth_method") or "oauth",
+        pass_prefix=data.get("pass_prefix") or "",
+        client_secret=data.get("client_secret"),
+        send_queue=bool(data.get("send_queue")),
+        max_size=data.get("max_size") or "",
+    )
@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from mutt_wizard.maildir import (
+    addresses,
+    folder_stamp,
+    iter_folders,
+    iter_messages,
+    read_message,
+)
+
+# Each message adds weight * 2 ** ((date - SCORE_EPOCH) / HALF_LIFE) to a
+# contact's score, so one sum ranks by frequency and recency without ever
+# having to be recomputed as time passes.
+SCORE_EPOCH = 946684800
+HALF_LIFE = 180 * 86400.0
+SENT_WEIGHT = 5.0
+# Received-only addresses seen once and not since are dropped.
+PRUNE_AFTER = 2 * 365 * 86400
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL,
+    low INTEGER NOT NULL,
+    high INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    address TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    received INTEGER NOT NULL,
+    sent INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    score REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contacts_score ON contacts (score);
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT NOT NULL,
+    contact INTEGER NOT NULL,
+    PRIMARY KEY (token, contact)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+_UID_RE = re.compile(r",U=(\d+)")
+_PREFIX_END = "\U0010ffff"
+CANDIDATE_LIMIT = 20000
+
+
+@dataclass
+class _Seen:
+    name: str = ""
+    date: int = 0
+    received: int = 0
+    sent: int = 0
+    score: float = 0.0
+
+
+@dataclass
+class ContactStats:
+    messages: int = 0
+    added: int = 0
+    updated: int = 0
+    pruned: int = 0
+
+
+def open_contacts(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _tokens(address: str, name: str) -> set[str]:
+    tokens = {address.rpartition("@")[2]}
+    tokens.update(word for word in re.split(r"[\s,.\"'()<>]+", _fold(name)) if word)
+    return tokens
+
+
+def _message_date(message, path: str, now: float) -> int:
+    try:
+        date = parsedate_to_datetime(message.get("Date", "")).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        date = os.stat(path).st_mtime
+    # Misdated mail must not outrank everything for years to come.
+    return int(min(date, now + 86400))
+
+
+def _record(
+    seen: dict[str, _Seen], name: str, address: str, date: int, sent: bool
+) -> None:
+    entry = seen.setdefault(address, _Seen())
+    if name and date >= entry.date:
+        entry.name = name
+    entry.date = max(entry.date, date)
+    if sent:
+        entry.sent += 1
+    else:
+        entry.received += 1
+    weight = SENT_WEIGHT if sent else 1.0
+    entry.score += weight * 2 ** ((date - SCORE_EPOCH) / HALF_LIFE)
+
+
+# Gmail keeps one copy of a message per label, and a message filed in several
+# folders must still count once, so each Message-ID is only read the first time.
+def _read(
+    conn: sqlite3.Connection,
+    path: str,
+    own: set[str],
+    seen: dict[str, _Seen],
+    now: float,
+) -> bool:
+    try:
+        message = read_message(path, headers_only=True)
+        date = _message_date(message, path, now)
+    except OSError:
+        return False
+    message_id = str(message.get("Message-ID", "")).strip()
+    if message_id:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO messages (message_id) VALUES (?)", (message_id,)
+        )
+        if not cursor.rowcount:
+            return False
+    senders = addresses(message, "From")
+    if any(address.lower() in own for _, address in senders):
+        for name, address in addresses(message, "To", "Cc", "Bcc"):
+            if address.lower() not in own:
+                _record(seen, name, address.lower(), date, sent=True)
+    else:
+        for name, address in senders:
+            _record(seen, name, address.lower(), date, sent=False)
+    return True
+
+
+# Only messages outside the IMAP UID range already read for a folder are
+# parsed: mbsync hands out increasing UIDs for new mail, and a staged backfill
+# brings in lower ones. Flag changes rename files but keep their UID.
+def _scan_folders(
+    conn: sqlite3.Connection,
+    root: Path,
+    own: set[str],
+    seen: dict[str, _Seen],
+    now: float,
+) -> int:
+    read = 0
+    for folder in iter_folders(root):
+        rel = folder.relative_to(root).as_posix()
+        stamp = folder_stamp(folder)
+        row = conn.execute(
+            "SELECT stamp, low, high FROM folders WHERE folder = ?", (rel,)
+        ).fetchone()
+        if row and row[0] == stamp:
+            continue
+        low, high = (row[1], row[2]) if row else (0, 0)
+        uids = []
+        for entry in iter_messages(folder):
+            match = _UID_RE.search(entry.name)
+            if not match:
+                continue
+            uid = int(match.group(1))
+            uids.append(uid)
+            if low <= uid <= high:
+                continue
+            if _read(conn, entry.path, own, seen, now):
+                read += 1
+        if uids:
+            low = min(uids) if (low, high) == (0, 0) else min(low, *uids)
+            high = max(high, *uids)
+        conn.execute(
+            "INSERT OR REPLACE INTO folders (folder, stamp, low, high) "
+            "VALUES (?, ?, ?, ?)",
+            (rel, stamp, low, high),
+        )
+    return read
+
+
+def _add_tokens(
+    conn: sqlite3.Connection, contact: int, address: str, name: str
+) -> None:
+    conn.executemany(
+        "INSERT OR IGNORE INTO tokens (token, contact) VALUES (?, ?)",
+        [(token, contact) for token in _tokens(address, name)],
+    )
+
+
+def _prune(conn: sqlite3.Connection, now: float) -> int:
+    rows = conn.execute(
+        "SELECT id, address, name FROM contacts "
+        "WHERE sent = 0 AND received <= 1 AND last_seen < ?",
+        (int(now - PRUNE_AFTER),),
+    ).fetchall()
+    for contact, address, name in rows:
+        conn.executemany(
+            "DELETE FROM tokens WHERE token = ? AND contact = ?",
+            [(token, contact) for token in _tokens(address, name)],
+        )
+        conn.execute("DELETE FROM contacts WHERE id = ?", (contact,))
+    return len(rows)
+
+
+def update_contacts(
+    conn: sqlite3.Connection, root: Path, own: set[str], now: float | None = None
+) -> ContactStats:
+    now = time.time() if now is None else now
+    own = {address.lower() for address in own}
+    seen: dict[str, _Seen] = {}
+    stats = ContactStats()
+    with conn:
+        if root.is_dir():
+            stats.messages = _scan_folders(conn, root, own, seen, now)
+        for address, entry in seen.items():
+            row = conn.execute(
+                "SELECT id, name, last_seen FROM contacts WHERE address = ?",
+                (address,),
+            ).fetchone()
+            if row is None:
+                cursor = conn.execute(
+                    "INSERT INTO contacts "
+                    "(address, name, received, sent, last_seen, score) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        address,
+                        entry.name,
+                        entry.received,
+                        entry.sent,
+                        entry.date,
+                        entry.score,
+                    ),
+                )
+                _add_tokens(conn, cursor.lastrowid, address, entry.name)
+                stats.added += 1
+                continue
+            contact, name, last_seen = row
+            if entry.name and entry.name != name and entry.date >= last_seen:
+                name = entry.name
+                _add_tokens(conn, contact, address, name)
+            conn.execute(
+                "UPDATE contacts SET name = ?, received = received + ?, "
+                "sent = sent + ?, last_seen = MAX(last_seen, ?), score = score + ? "
+                "WHERE id = ?",
+                (name, entry.received, entry.sent, entry.date, entry.score, contact),
+            )
+            stats.updated += 1
+        stats.pruned = _prune(conn, now)
+    return stats
+
+
+def _matches(address: str, name: str, words: list[str]) -> bool:
+    tokens = _tokens(address, name) | {address}
+    return all(any(token.startswith(word) for token in tokens) for word in words)
+
+
+_WORD_MATCHES = (
+    "SELECT id FROM contacts WHERE address >= ? AND address < ? "
+    "UNION ALL SELECT contact FROM tokens WHERE token >= ? AND token < ?"
+)
+
+
+def _word_params(word: str) -> tuple[str, str, str, str]:
+    return word, word + _PREFIX_END, word, word + _PREFIX_END
+
+
+def _count_matches(conn: sqlite3.Connection, word: str) -> int:
+    return conn.execute(
+        f"SELECT count(*) FROM ({_WORD_MATCHES} LIMIT ?)",
+        (*_word_params(word), CANDIDATE_LIMIT + 1),
+    ).fetchone()[0]
+
+
+# The rarest word picks candidates through the address and token indexes and
+# the other words are checked per row. When every word is common, walking
+# contacts from the highest score down meets enough matches within a few
+# thousand rows.
+def query_contacts(
+    conn: sqlite3.Connection, query: str, limit: int = 30
+) -> list[tuple[str, str, int, int]]:
+    words = [word for word in re.split(r"[\s,]+", _fold(query)) if word]
+    columns = "SELECT address, name, sent, received FROM contacts"
+    rows = None
+    if words:
+        counts = {word: _count_matches(conn, word) for word in words}
+        rarest = min(words, key=counts.__getitem__)
+        if counts[rarest] <= CANDIDATE_LIMIT:
+            rows = conn.execute(
+                f"{columns} WHERE id IN ({_WORD_MATCHES}) ORDER BY score DESC",
+                _word_params(rarest),
+            )
+            words = [word for word in words if word != rarest]
+    if rows is None:
+        rows = conn.execute(f"{columns} ORDER BY score DESC")
+    results: list[tuple[str, str, int, int]] = []
+    for row in rows:
+        if _matches(row[0], row[1], words):
+            results.append(row)
+            if len(results) == limit:
+                break
+    return results
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import subprocess
+from pathlib import Path
+
+from mutt_wizard.config import Account, Paths
+
+
+def uses_oauth(account: Account) -> bool:
+    return account.is_gmail and account.auth_method == "oauth"
+
+
+def password(account: Account) -> str:
+    result = subprocess.run(
+        ["pass", f"{account.pass_prefix}{account.email}"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f"pass has no password for {account.email}")
+    return result.stdout.splitlines()[0]
+
+
+def oauth_token(paths: Paths, account: Account) -> str:
+    # Imported lazily so password accounts work without the Google libraries.
+    from mutt_wizard.oauth import access_token
+
+    if not account.client_secret:
+        raise RuntimeError(f"{account.email} does not have a stored client_secret")
+    return access_token(
+        account.email,
+        Path(account.client_secret),
+        paths.tokens_dir / f"{account.email}.json",
+    )
+
+
+def xoauth2_string(login: str, token: str) -> str:
+    return f"user={login}\x01auth=Bearer {token}\x01\x01"
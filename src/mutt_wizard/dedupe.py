@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+
+from mutt_wizard.maildir import (
+    folder_stamp,
+    header,
+    iter_folders,
+    iter_messages,
+    read_message,
+    split_name,
+)
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    account TEXT NOT NULL,
+    path TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    UNIQUE (folder, uid)
+);
+CREATE INDEX IF NOT EXISTS files_key ON files (account, message_id, size);
+"""
+# Syncs of different accounts update the shared index. Take it after the
+# account's own lock.
+LOCK_NAME = "dedupe"
+
+
+@dataclass
+class DedupeStats:
+    scanned: int = 0
+    linked: int = 0
+    reclaimed: int = 0
+
+
+def open_db(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _stored_digest(
+    conn: sqlite3.Connection, rowid: int, path: str, digest: str | None
+) -> str:
+    if digest is None:
+        digest = _digest(path)
+        conn.execute("UPDATE files SET digest = ? WHERE id = ?", (digest, rowid))
+    return digest
+
+
+def _link(source: str, target: str, expected: os.stat_result) -> bool:
+    current = os.stat(target)
+    if (current.st_ino, current.st_size) != (expected.st_ino, expected.st_size):
+        return False
+    tmp = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.mwlink")
+    try:
+        os.link(source, tmp)
+        os.replace(tmp, target)
+    except OSError:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        return False
+    return True
+
+
+def _dedupe_file(
+    conn: sqlite3.Connection,
+    account: str,
+    message_id: str,
+    path: str,
+    stat: os.stat_result,
+    stats: DedupeStats,
+) -> str | None:
+    twins = conn.execute(
+        "SELECT id, path, digest FROM files "
+        "WHERE account = ? AND message_id = ? AND size = ?",
+        (account, message_id, stat.st_size),
+    ).fetchall()
+    if not twins:
+        return None
+    digest = _digest(path)
+    for rowid, other, other_digest in twins:
+        try:
+            other_stat = os.stat(other)
+            if other_stat.st_ino == stat.st_ino and other_stat.st_dev == stat.st_dev:
+                return digest
+            if other_stat.st_dev != stat.st_dev:
+                continue
+            if _stored_digest(conn, rowid, other, other_digest) != digest:
+                continue
+        except OSError:
+            continue
+        if _link(other, path, stat):
+            stats.linked += 1
+            if stat.st_nlink == 1:
+                stats.reclaimed += stat.st_size
+        return digest
+    return digest
+
+
+def _update_folder(
+    conn: sqlite3.Connection, folder: Path, rel: str, stats: DedupeStats
+) -> None:
+    account = rel.split("/", 1)[0]
+    known = {
+        uid: (rowid, path)
+        for rowid, uid, path in conn.execute(
+            "SELECT id, uid, path FROM files WHERE folder = ?", (rel,)
+        )
+    }
+    for entry in iter_messages(folder):
+        uid, _ = split_name(entry.name)
+        row = known.pop(uid, None)
+        if row is not None:
+            if row[1] != entry.path:
+                conn.execute(
+                    "UPDATE files SET path = ? WHERE id = ?", (entry.path, row[0])
+                )
+            continue
+        try:
+            stat = entry.stat()
+            message_id = header(read_message(entry.path), "Message-ID")
+            digest = None
+            if message_id:
+                digest = _dedupe_file(
+                    conn, account, message_id, entry.path, stat, stats
+                )
+        except OSError:
+            continue
+        stats.scanned += 1
+        conn.execute(
+            "INSERT INTO files (folder, uid, account, path, message_id, size, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (rel, uid, account, entry.path, message_id, stat.st_size, digest),
+        )
+    conn.executemany(
+        "DELETE FROM files WHERE id = ?", [(rowid,) for rowid, _ in known.values()]
+    )
+
+
+def dedupe_account(
+    conn: sqlite3.Connection, maildir_root: Path, account: str
+) -> DedupeStats:
+    stats = DedupeStats()
+    prefix = f"{account}/"
+    stamps = {
+        folder: stamp
+        for folder, stamp in conn.execute("SELECT folder, stamp FROM folders")
+        if folder.startswith(prefix)
+    }
+    seen = set()
+    account_root = maildir_root / account
+    if account_root.is_dir():
+        for folder in iter_folders(account_root):
+            rel = folder.relative_to(maildir_root).as_posix()
+            seen.add(rel)
+            stamp = folder_stamp(folder)
+            if stamps.get(rel) == stamp:
+                continue
+            with conn:
+                _update_folder(conn, folder, rel, stats)
+                conn.execute(
+                    "INSERT OR REPLACE INTO folders (folder, stamp) VALUES (?, ?)",
+                    (rel, stamp),
+                )
+    for rel in set(stamps) - seen:
+        with conn:
+            conn.execute("DELETE FROM files WHERE folder = ?", (rel,))
+            conn.execute("DELETE FROM folders WHERE folder = ?", (rel,))
+    return stats
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
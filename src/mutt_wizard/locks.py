@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+
+def _safe_name(name: str) -> str:
+    return "".join(ch if ch.isalnum() or ch in "@.-_" else "_" for ch in name)
+
+
+def _waiting_pid(marker: Path) -> int | None:
+    try:
+        pid = int(marker.read_text())
+        os.kill(pid, 0)
+    except PermissionError:
+        return pid
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+def _clear_marker(marker: Path) -> None:
+    if _waiting_pid(marker) in (os.getpid(), None):
+        marker.unlink(missing_ok=True)
+
+
+# Every request marks <name>.pending before taking the lock. The holder keeps
+# running the job while the marker is set, clearing it before each run, so a
+# burst of requests costs the in-flight run plus at most one follow-up. When the
+# lock is taken, callers either return at once (wait=False) or block until a run
+# that started after their request has finished. Returns how many times this
+# process ran the job.
+#
+# A holder runs follow-ups at its own priority, which a process that lowered
+# its nice level cannot raise again. An urgent caller that waits therefore also
+# writes its pid to <name>.urgent, and other holders hand the follow-up over to
+# it instead of running it themselves.
+def run_coalesced(
+    lock_dir: Path,
+    name: str,
+    job: Callable[[], None],
+    wait: bool = True,
+    urgent: bool = False,
+) -> int:
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    base = _safe_name(name)
+    pending = lock_dir / f"{base}.pending"
+    marker = lock_dir / f"{base}.urgent"
+    if urgent and wait:
+        marker.write_text(str(os.getpid()))
+    pending.touch()
+    runs = 0
+    try:
+        with open(lock_dir / f"{base}.lock", "a") as handle:
+            while True:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if not wait:
+                        return runs
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                handed_over = False
+                try:
+                    if urgent:
+                        _clear_marker(marker)
+                    while pending.exists():
+                        if not urgent and _waiting_pid(marker):
+                            handed_over = True
+                            break
+                        pending.unlink(missing_ok=True)
+                        job()
+                        runs += 1
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                if handed_over:
+                    if not wait:
+                        return runs
+                    # Block again once the urgent caller holds the lock.
+                    while _waiting_pid(marker):
+                        time.sleep(0.1)
+                    continue
+                # A request may have arrived between the last check and unlocking.
+                if not pending.exists():
+                    return runs
+    finally:
+        if urgent:
+            _clear_marker(marker)
+
+
+@contextmanager
+def hold_lock(lock_dir: Path, name: str) -> Iterator[None]:
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(lock_dir / f"{_safe_name(name)}.lock", "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+from email.errors import HeaderParseError
+from email.header import Header, decode_header, make_header
+from email.message import Message
+from email.parser import BytesParser
+from email.policy import compat32
+from email.utils import getaddresses
+from pathlib import Path
+from typing import Iterator
+
+INFO_SEP = ":2,"
+HEADER_BYTES = 32 * 1024
+
+
+def split_name(name: str) -> tuple[str, str]:
+    uid, _, flags = name.partition(INFO_SEP)
+    return uid, flags
+
+
+def iter_folders(root: Path) -> Iterator[Path]:
+    for dirpath, dirnames, _ in os.walk(root):
+        if "cur" in dirnames and "new" in dirnames:
+            yield Path(dirpath)
+        dirnames[:] = sorted(
+            name for name in dirnames if name not in ("cur", "new", "tmp")
+        )
+
+
+def folder_stamp(folder: Path) -> str:
+    return ":".join(
+        str((folder / sub).stat().st_mtime_ns) for sub in ("cur", "new")
+    )
+
+
+def iter_messages(folder: Path) -> Iterator[os.DirEntry]:
+    for sub in ("new", "cur"):
+        try:
+            entries = os.scandir(folder / sub)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.name.startswith(".") and entry.is_file():
+                    yield entry
+
+
+def read_message(
+    path: str | Path, limit: int = HEADER_BYTES, headers_only: bool = False
+) -> Message:
+    with open(path, "rb") as handle:
+        data = handle.read(limit)
+    return BytesParser(policy=compat32).parsebytes(data, headersonly=headers_only)
+
+
+def decode(value: str) -> str:
+    if "=?" not in value:
+        return " ".join(value.split())
+    try:
+        value = str(make_header(decode_header(value)))
+    except (HeaderParseError, LookupError, UnicodeError, ValueError):
+        pass
+    return " ".join(value.split())
+
+
+def _raw_text(value: str | Header) -> str:
+    if isinstance(value, Header):
+        # Raw 8-bit headers come back as Header objects; assume UTF-8.
+        return "".join(
+            part.decode("utf-8", errors="replace") if isinstance(part, bytes) else part
+            for part, _ in decode_header(value)
+        )
+    return str(value)
+
+
+def header(message: Message, name: str) -> str:
+    value = message.get(name)
+    if value is None:
+        return ""
+    return decode(_raw_text(value))
+
+
+# Addresses are split before decoding so encoded display names may hold commas.
+def addresses(message: Message, *names: str) -> list[tuple[str, str]]:
+    values = [_raw_text(value) for name in names for value in message.get_all(name, [])]
+    return [
+        (decode(realname), address)
+        for realname, address in getaddresses(values)
+        if "@" in address
+    ]
+
+
+def text_snippet(message: Message, size: int = 400) -> str:
+    for part in message.walk():
+        if part.get_content_type() != "text/plain":
+            continue
+        payload = part.get_payload(decode=True)
+        if not isinstance(payload, bytes):
+            return ""
+        charset = part.get_content_charset() or "utf-8"
+        try:
+            text = payload[: size * 4].decode(charset, errors="replace")
+        except LookupError:
+            text = payload[: size * 4].decode("utf-8", errors="replace")
+        return " ".join(text.split())[:size]
+    return ""
@@ -5,9 +5,34 @@ import os
 import shutil
 import subprocess
 import sys
+import time
 from pathlib import Path
 
-from mutt_wizard.config import default_sasl_path, ensure_dirs, get_paths
+from mutt_wizard.backfill import after_sync, before_sync
+from mutt_wizard.circuit import check_hosts, load_state, save_state
+from mutt_wizard.config import (
+    default_sasl_path,
+    ensure_dirs,
+    get_paths,
+    load_accounts,
+    read_env_file,
+    write_env_value,
+)
+from mutt_wizard.contacts import open_contacts, update_contacts
+from mutt_wizard.dedupe import LOCK_NAME as DEDUPE_LOCK
+from mutt_wizard.dedupe import dedupe_account, format_size, open_db
+from mutt_wizard.locks import hold_lock, run_coalesced
+from mutt_wizard.oversized import record_oversized
+from mutt_wizard.resources import apply_limits, enter_scope, load_limits
+from mutt_wizard.sendq import queued_accounts, spawn_flusher
+from mutt_wizard.search import open_index, update_index
+from mutt_wizard.tagging import (
+    NEW_TAG,
+    apply_rules,
+    load_rules,
+    new_tag_configured,
+    profile_rules,
+)
 
 
 def _channels_from_mbsync(config_path: Path) -> list[str]:
@@ -22,28 +47,201 @@ def _channels_from_mbsync(config_path: Path) -> list[str]:
     return channels
 
 
+def _reachable_accounts(paths, accounts: list[str], explicit: bool) -> list[str]:
+    stored = load_accounts(paths)
+    hosts = {}
+    for account in accounts:
+        info = stored.get(account)
+        if info and info.get("imap_host"):
+            hosts[account] = (info["imap_host"], int(info.get("imap_port") or 993))
+    if not hosts:
+        return accounts
+
+    states = load_state(paths.circuit_state)
+    now = time.time()
+    results = check_hosts(list(hosts.values()), states, now, probe_open=explicit)
+    try:
+        save_state(paths.circuit_state, states)
+    except OSError as exc:
+        print(
+            f"warning: could not write {paths.circuit_state}: {exc}",
+            file=sys.stderr,
+        )
+
+    reachable = []
+    for account in accounts:
+        if account not in hosts:
+            reachable.append(account)
+            continue
+        host, port = hosts[account]
+        key = f"{host}:{port}"
+        if results.get(key):
+            reachable.append(account)
+            continue
+        retry = max(0, int(states[key].retry_at - now))
+        print(f"Skipping {account}: {host} unreachable, retrying in {retry}s.")
+    return reachable
+
+
+# Runs under the account's lock (see run_coalesced in main).
+def _sync_account(
+    paths, account: str, cmd: list[str], env: dict[str, str], max_size: bool
+) -> None:
+    boxes = before_sync(paths, account)
+    target = f"{account}:{','.join(boxes)}" if boxes else account
+    result = subprocess.run([*cmd, target], check=False, env=env)
+    state = after_sync(paths, account, result.returncode == 0)
+    if state is not None and state.stage != "done":
+        print(f"{account}: staged sync at {state.limit} messages per folder")
+    if max_size:
+        _record_oversized(paths, account)
+    if paths.dedupe_index.exists():
+        _dedupe(paths, account)
+
+
+def _record_oversized(paths, account: str) -> None:
+    skipped = record_oversized(paths, account)
+    if skipped:
+        print(
+            f"{account}: {len(skipped)} message(s) over MaxSize "
+            f"(mw fetch --list {account})"
+        )
+
+
+# Runs inside _sync_account, so mbsync cannot rename files under _link.
+def _dedupe(paths, account: str) -> None:
+    with hold_lock(paths.locks_dir, DEDUPE_LOCK):
+        conn = open_db(paths.dedupe_index)
+        try:
+            stats = dedupe_account(conn, paths.maildir_root, account)
+        finally:
+            conn.close()
+    if stats.linked:
+        print(
+            f"dedupe {account}: linked {stats.linked}, "
+            f"reclaimed {format_size(stats.reclaimed)}"
+        )
+
+
+def _update_search_index(paths) -> None:
+    try:
+        conn = open_index(paths.search_index)
+    except RuntimeError as exc:
+        print(f"warning: {exc}", file=sys.stderr)
+        return
+    try:
+        stats = update_index(conn, paths.maildir_root)
+    finally:
+        conn.close()
+    if stats.added or stats.removed:
+        print(f"search index: +{stats.added} -{stats.removed}")
+
+
+# The index is created by "mw contacts --update"; syncs only keep it current.
+def _update_contacts(paths, channels: list[str]) -> None:
+    if not paths.contacts_index.exists():
+        return
+    conn = open_contacts(paths.contacts_index)
+    try:
+        stats = update_contacts(conn, paths.maildir_root, set(channels))
+    finally:
+        conn.close()
+    if stats.added:
+        print(f"contacts: +{stats.added}")
+
+
+def _run_tag_rules(rules_path: Path, env: dict[str, str], profile: bool) -> None:
+    try:
+        rules = load_rules(rules_path)
+    except (OSError, ValueError) as exc:
+        print(f"warning: skipping tag rules: {exc}", file=sys.stderr)
+        return
+    if not rules:
+        return
+    if not new_tag_configured(env):
+        print(
+            f'warning: skipping tag rules: new.tags lacks "{NEW_TAG}" '
+            f'(notmuch config set new.tags "{NEW_TAG};unread;inbox")',
+            file=sys.stderr,
+        )
+        return
+    if profile:
+        total = 0.0
+        for rule, matched, elapsed in profile_rules(rules, env):
+            total += elapsed
+            print(
+                f"tag rule line {rule.line}: {matched} new message(s) "
+                f"in {elapsed:.3f}s ({' '.join(rule.tags)})"
+            )
+        print(f"tagging: {len(rules)} rule(s) in {total:.3f}s")
+        return
+    try:
+        elapsed = apply_rules(rules, env)
+    except RuntimeError as exc:
+        print(f"warning: {exc}", file=sys.stderr)
+        return
+    print(f"tagging: {len(rules)} rule(s) in {elapsed:.3f}s")
+
+
+def _post_sync(paths, channels: list[str], env: dict[str, str], args) -> None:
+    if paths.search_index.exists():
+        _update_search_index(paths)
+    _update_contacts(paths, channels)
+
+    notmuch_config = Path(
+        os.environ.get("NOTMUCH_CONFIG", "~/.notmuch-config")
+    ).expanduser()
+    if not args.no_notmuch and shutil.which("notmuch") and notmuch_config.exists():
+        subprocess.run(["notmuch", "new", "--quiet"], check=False)
+        if paths.tag_rules.exists():
+            _run_tag_rules(paths.tag_rules, env, args.tag_profile)
+
+
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(prog="mailsync")
     parser.add_argument("accounts", nargs="*")
     parser.add_argument("--no-notmuch", action="store_true")
+    parser.add_argument(
+        "--tag-profile",
+        action="store_true",
+        help="Apply tag rules one at a time and report per-rule timing",
+    )
     parser.add_argument("--sasl-path", help="Path to SASL plugin directory")
+    parser.add_argument(
+        "--detach",
+        action="store_true",
+        help="Do not wait if an account is already syncing; queue a follow-up run",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Sync even if the IMAP host looks unreachable",
+    )
+    parser.add_argument(
+        "--full-priority",
+        action="store_true",
+        help="Do not lower CPU and I/O priority (for syncs started by hand)",
+    )
     args = parser.parse_args(argv)
 
     paths = get_paths()
+    try:
+        limits = load_limits(
+            {**read_env_file(paths), **os.environ}, args.full_priority
+        )
+    except ValueError as exc:
+        print(f"ERROR: {exc}", file=sys.stderr)
+        return 1
+    enter_scope(limits, sys.argv[1:] if argv is None else argv)
+    for warning in apply_limits(limits):
+        print(f"warning: {warning}", file=sys.stderr)
     ensure_dirs(paths)
     channels = _channels_from_mbsync(paths.mbsync_config)
     if not channels:
         print("No accounts configured.")
         return 1
 
-    env = os.environ.copy()
-    if paths.env_file.exists():
-        for line in paths.env_file.read_text(encoding="utf-8").splitlines():
-            if not line.strip() or line.strip().startswith("#"):
-                continue
-            if "=" in line:
-                key, value = line.split("=", 1)
-                env[key.strip()] = value.strip()
+    env = {**os.environ, **read_env_file(paths)}
 
     sasl_path = args.sasl_path or default_sasl_path()
     if sys.platform == "darwin":
@@ -55,19 +253,28 @@ def main(argv: list[str] | None = None) -> int:
         env["SASL_PATH"] = sasl_path
         os.environ["SASL_PATH"] = sasl_path
         try:
-            paths.env_file.parent.mkdir(parents=True, exist_ok=True)
-            paths.env_file.write_text(f"SASL_PATH={sasl_path}\n", encoding="utf-8")
+            write_env_value(paths, "SASL_PATH", sasl_path)
         except OSError as exc:
             print(
                 f"warning: could not write {paths.env_file}: {exc}",
                 file=sys.stderr,
             )
 
-    targets = args.accounts or channels
-    for account in targets:
+    targets = []
+    for account in args.accounts or channels:
         if account not in channels:
             print(f"ERROR: Account {account} not found.")
             continue
+        targets.append(account)
+    if not args.force:
+        # Naming accounts or asking for full priority means a user is waiting.
+        explicit = bool(args.accounts) or args.full_priority
+        targets = _reachable_accounts(paths, targets, explicit)
+
+    stored = load_accounts(paths)
+    synced = []
+    for account in targets:
+        max_size = bool(stored.get(account, {}).get("max_size"))
         if sasl_path:
             cmd = [
                 "/usr/bin/env",
@@ -76,17 +283,32 @@ def main(argv: list[str] | None = None) -> int:
                 "-c",
                 str(paths.mbsync_config),
                 "-q",
-                account,
             ]
         else:
-            cmd = ["mbsync", "-c", str(paths.mbsync_config), "-q", account]
-        subprocess.run(cmd, check=False, env=env)
+            cmd = ["mbsync", "-c", str(paths.mbsync_config), "-q"]
+        runs = run_coalesced(
+            paths.locks_dir,
+            account,
+            lambda account=account, cmd=cmd, max_size=max_size: _sync_account(
+                paths, account, cmd, env, max_size
+            ),
+            wait=not args.detach,
+            urgent=args.full_priority,
+        )
+        if runs:
+            synced.append(account)
 
-    notmuch_config = Path(
-        os.environ.get("NOTMUCH_CONFIG", "~/.notmuch-config")
-    ).expanduser()
-    if not args.no_notmuch and shutil.which("notmuch") and notmuch_config.exists():
-        subprocess.run(["notmuch", "new", "--quiet"], check=False)
+    if queued_accounts(paths):
+        spawn_flusher(paths)
+
+    if synced:
+        run_coalesced(
+            paths.locks_dir,
+            "post-sync",
+            lambda: _post_sync(paths, channels, env, args),
+            wait=not args.detach,
+            urgent=args.full_priority,
+        )
 
     return 0
 
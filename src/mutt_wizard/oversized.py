@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+from mutt_wizard.config import Paths, write_json
+from mutt_wizard.locks import hold_lock
+from mutt_wizard.maildir import (
+    INFO_SEP,
+    folder_stamp,
+    header,
+    iter_folders,
+    iter_messages,
+    read_message,
+    split_name,
+)
+
+# isync 1.5+ propagates messages over MaxSize as placeholders with this prefix.
+PLACEHOLDER_PREFIX = "[placeholder]"
+# Guards oversized.json, which syncs of different accounts update.
+LOCK_NAME = "oversized"
+
+
+def load_oversized(paths: Paths) -> Dict[str, Dict[str, Any]]:
+    try:
+        return json.loads(paths.oversized_state.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_oversized(paths: Paths, data: Dict[str, Dict[str, Any]]) -> None:
+    write_json(paths.oversized_state, data)
+
+
+def _placeholder_subject(path: str) -> str | None:
+    try:
+        subject = header(read_message(path, 8192), "Subject")
+    except OSError:
+        return None
+    if subject.startswith(PLACEHOLDER_PREFIX):
+        return subject[len(PLACEHOLDER_PREFIX) :].strip()
+    return None
+
+
+def _folder_files(folder: Path) -> Dict[str, str]:
+    return {split_name(entry.name)[0]: entry.path for entry in iter_messages(folder)}
+
+
+# Callers hold the account's lock, so mbsync does not move files mid-scan;
+# neomutt still may, hence the per-file OSError handling. Folders whose cur/new
+# mtimes are unchanged since the last scan are skipped.
+def record_oversized(paths: Paths, email: str, full: bool = False) -> list[dict]:
+    with hold_lock(paths.locks_dir, LOCK_NAME):
+        entry = load_oversized(paths).get(email, {})
+    since = 0.0 if full else entry.get("scanned_at", 0.0) - 1
+    stamps = {} if full else entry.get("folders", {})
+    started = time.time()
+    root = paths.maildir_root / email
+
+    listings: Dict[str, Dict[str, str]] = {}
+    messages = []
+    for message in entry.get("messages", []):
+        files = listings.setdefault(
+            message["folder"], _folder_files(root / message["folder"])
+        )
+        path = files.get(message["uid"])
+        if path and _placeholder_subject(path) is not None:
+            messages.append(message)
+    known = {(message["folder"], message["uid"]) for message in messages}
+
+    scanned: Dict[str, str] = {}
+    if root.is_dir():
+        for folder in iter_folders(root):
+            rel = folder.relative_to(root).as_posix()
+            try:
+                scanned[rel] = folder_stamp(folder)
+            except OSError:
+                continue
+            if stamps.get(rel) == scanned[rel]:
+                continue
+            for item in iter_messages(folder):
+                uid = split_name(item.name)[0]
+                if (rel, uid) in known:
+                    continue
+                try:
+                    if item.stat().st_ctime < since:
+                        continue
+                except OSError:
+                    continue
+                subject = _placeholder_subject(item.path)
+                if subject is not None:
+                    messages.append({"folder": rel, "uid": uid, "subject": subject})
+
+    with hold_lock(paths.locks_dir, LOCK_NAME):
+        data = load_oversized(paths)
+        data[email] = {
+            "scanned_at": started,
+            "folders": scanned,
+            "messages": messages,
+        }
+        save_oversized(paths, data)
+    return messages
+
+
+def _flag(path: str) -> None:
+    directory, name = os.path.split(path)
+    uid, flags = split_name(name)
+    if "F" in flags and os.path.basename(directory) == "cur":
+        return
+    flags = "".join(sorted(set(flags) | {"F"}))
+    cur = os.path.join(os.path.dirname(directory), "cur")
+    os.rename(path, os.path.join(cur, f"{uid}{INFO_SEP}{flags}"))
+
+
+def without_max_size(config: str, email: str) -> str:
+    lines = []
+    in_store = False
+    for line in config.splitlines():
+        if line.startswith("MaildirStore ") or line.startswith("IMAPStore "):
+            in_store = line.split()[1:2] == [f"{email}-local"]
+        elif line.startswith("Channel "):
+            in_store = False
+        if in_store and line.startswith("MaxSize "):
+            continue
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+# Fetches oversized messages in full: the requested placeholders are flagged
+# (what isync 1.5 expects before upgrading them) and their folders are synced
+# once with the account's MaxSize removed, which also picks up messages that
+# older isync versions skipped without a placeholder.
+def fetch_oversized(
+    paths: Paths,
+    email: str,
+    folders: list[str],
+    env: Dict[str, str] | None = None,
+) -> int:
+    root = paths.maildir_root / email
+    boxes = set(folders)
+    with hold_lock(paths.locks_dir, email):
+        for message in record_oversized(paths, email):
+            if folders and message["folder"] not in boxes:
+                continue
+            path = _folder_files(root / message["folder"]).get(message["uid"])
+            if path is None:
+                continue
+            if folders:
+                _flag(path)
+            elif "F" in split_name(os.path.basename(path))[1]:
+                boxes.add(message["folder"])
+        if not boxes:
+            print(f"{email}: no flagged oversized messages to fetch.")
+            return 0
+
+        config = paths.state_dir / "mbsyncrc.fetch"
+        config.parent.mkdir(parents=True, exist_ok=True)
+        config.write_text(
+            without_max_size(paths.mbsync_config.read_text(encoding="utf-8"), email),
+            encoding="utf-8",
+        )
+        config.chmod(0o600)
+        target = f"{email}:{','.join(sorted(boxes))}"
+        result = subprocess.run(
+            ["mbsync", "-c", str(config), "-q", target], check=False, env=env
+        )
+        remaining = record_oversized(paths, email, full=True)
+    print(f"{email}: fetched {target}; {len(remaining)} oversized message(s) left.")
+    return result.returncode
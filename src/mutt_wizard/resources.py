@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict
+
+SCOPE_MARKER = "MW_SYNC_SCOPE"
+IO_CLASSES = {"none": None, "best-effort": "2", "idle": "3"}
+_MEMORY_RE = re.compile(r"(\d+)([KMG]?)", re.IGNORECASE)
+_QUOTA_RE = re.compile(r"\d+%")
+
+
+@dataclass
+class SyncLimits:
+    nice: int = 10
+    io_class: str = "best-effort"
+    io_level: int = 7
+    memory_max: str = ""
+    cpu_quota: str = ""
+
+
+def load_limits(settings: Dict[str, str], full_priority: bool = False) -> SyncLimits:
+    limits = SyncLimits()
+    try:
+        limits.nice = int(settings.get("MW_SYNC_NICE", limits.nice))
+    except ValueError:
+        raise ValueError("MW_SYNC_NICE must be a number from 0 to 19") from None
+    io_class, _, level = settings.get("MW_SYNC_IONICE", "best-effort:7").partition(":")
+    if io_class not in IO_CLASSES or (level and not level.isdigit()):
+        raise ValueError("MW_SYNC_IONICE must be none, idle or best-effort[:0-7]")
+    limits.io_class = io_class
+    limits.io_level = min(int(level), 7) if level else 4
+    limits.memory_max = settings.get("MW_SYNC_MEMORY_MAX", "")
+    if limits.memory_max and not _MEMORY_RE.fullmatch(limits.memory_max):
+        raise ValueError("MW_SYNC_MEMORY_MAX must look like 512M or 2G")
+    limits.cpu_quota = settings.get("MW_SYNC_CPU_QUOTA", "")
+    if limits.cpu_quota and not _QUOTA_RE.fullmatch(limits.cpu_quota):
+        raise ValueError("MW_SYNC_CPU_QUOTA must be a percentage such as 50%")
+    if full_priority:
+        # Caps on memory still apply; only the scheduling is left alone.
+        limits.nice = 0
+        limits.io_class = "none"
+        limits.cpu_quota = ""
+    return limits
+
+
+def _memory_bytes(value: str) -> int:
+    number, unit = _MEMORY_RE.fullmatch(value).groups()
+    scale = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    return int(number) * scale[unit.upper()]
+
+
+def _user_systemd() -> bool:
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    return bool(
+        shutil.which("systemd-run")
+        and runtime
+        and Path(runtime, "systemd", "private").exists()
+    )
+
+
+# With a memory or CPU cap and a systemd user manager, mailsync re-executes
+# itself in a transient scope, so the cgroup caps cover it and everything it
+# starts. Returns when there is nothing to do or no scope can be had.
+def enter_scope(limits: SyncLimits, argv: list[str]) -> None:
+    if not (limits.memory_max or limits.cpu_quota):
+        return
+    if os.environ.get(SCOPE_MARKER) or not _user_systemd():
+        return
+    properties = []
+    if limits.memory_max:
+        properties += ["-p", f"MemoryMax={limits.memory_max}"]
+    if limits.cpu_quota:
+        properties += ["-p", f"CPUQuota={limits.cpu_quota}"]
+    os.environ[SCOPE_MARKER] = "1"
+    sys.stdout.flush()
+    os.execvp(
+        "systemd-run",
+        [
+            "systemd-run",
+            "--user",
+            "--scope",
+            "--quiet",
+            "--collect",
+            *properties,
+            "--",
+            sys.executable,
+            "-m",
+            "mutt_wizard.mailsync",
+            *argv,
+        ],
+    )
+
+
+# Lowers the priority of the running mailsync; mbsync, notmuch and the other
+# children inherit nice level, I/O class and rlimits from it. Returns warnings
+# for limits that could not be applied.
+def apply_limits(limits: SyncLimits) -> list[str]:
+    warnings = []
+    if limits.nice:
+        try:
+            current = os.getpriority(os.PRIO_PROCESS, 0)
+            os.setpriority(os.PRIO_PROCESS, 0, max(current, min(limits.nice, 19)))
+        except OSError as exc:
+            warnings.append(f"could not set nice level: {exc}")
+
+    io_class = IO_CLASSES[limits.io_class]
+    if io_class and sys.platform.startswith("linux") and shutil.which("ionice"):
+        cmd = ["ionice", "-c", io_class, "-p", str(os.getpid())]
+        if io_class == "2":
+            cmd[3:3] = ["-n", str(limits.io_level)]
+        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
+        if result.returncode != 0:
+            warnings.append(f"could not set I/O class: {result.stderr.strip()}")
+
+    in_scope = bool(os.environ.get(SCOPE_MARKER))
+    if limits.memory_max and not in_scope:
+        # Without a cgroup the cap is per process, on address space.
+        try:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            soft = _memory_bytes(limits.memory_max)
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+        except (OSError, ValueError) as exc:
+            warnings.append(f"could not limit memory: {exc}")
+    if limits.cpu_quota and not in_scope:
+        warnings.append("MW_SYNC_CPU_QUOTA needs a systemd user session; ignored")
+    return warnings
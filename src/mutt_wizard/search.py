@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from mutt_wizard.maildir import (
+    folder_stamp,
+    header,
+    iter_folders,
+    iter_messages,
+    read_message,
+    split_name,
+    text_snippet,
+)
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    UNIQUE (folder, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    subject, sender, recipients, snippet,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+COLUMNS = ("subject", "sender", "recipients", "snippet")
+_OPERATORS = {"AND", "OR", "NOT"}
+_QUERY_RE = re.compile(
+    r'(?P<paren>[()])|(?P<word>[^\s()"]*(?:"(?:[^"]|"")*")?[^\s()]*)'
+)
+
+
+@dataclass
+class IndexStats:
+    added: int = 0
+    moved: int = 0
+    removed: int = 0
+
+
+def open_index(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    try:
+        conn.executescript(SCHEMA)
+    except sqlite3.OperationalError as exc:
+        conn.close()
+        raise RuntimeError(f"SQLite FTS5 is required for mw search: {exc}") from exc
+    return conn
+
+
+def _message_date(message, path: str) -> int:
+    try:
+        return int(parsedate_to_datetime(header(message, "Date")).timestamp())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return int(os.stat(path).st_mtime)
+
+
+def _index_message(conn: sqlite3.Connection, folder: str, uid: str, path: str) -> bool:
+    try:
+        message = read_message(path)
+        date = _message_date(message, path)
+    except OSError:
+        return False
+    cursor = conn.execute(
+        "INSERT INTO messages (folder, uid, path, date) VALUES (?, ?, ?, ?)",
+        (folder, uid, path, date),
+    )
+    conn.execute(
+        "INSERT INTO messages_fts (rowid, subject, sender, recipients, snippet) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (
+            cursor.lastrowid,
+            header(message, "Subject"),
+            header(message, "From"),
+            " ".join(header(message, name) for name in ("To", "Cc")),
+            text_snippet(message),
+        ),
+    )
+    return True
+
+
+def _remove_rows(conn: sqlite3.Connection, rowids: list[int]) -> None:
+    conn.executemany("DELETE FROM messages WHERE id = ?", [(r,) for r in rowids])
+    conn.executemany("DELETE FROM messages_fts WHERE rowid = ?", [(r,) for r in rowids])
+
+
+def _update_folder(
+    conn: sqlite3.Connection, folder: Path, rel: str, stats: IndexStats
+) -> None:
+    known = {
+        uid: (rowid, path)
+        for rowid, uid, path in conn.execute(
+            "SELECT id, uid, path FROM messages WHERE folder = ?", (rel,)
+        )
+    }
+    for entry in iter_messages(folder):
+        uid, _ = split_name(entry.name)
+        row = known.pop(uid, None)
+        if row is None:
+            if _index_message(conn, rel, uid, entry.path):
+                stats.added += 1
+        elif row[1] != entry.path:
+            conn.execute(
+                "UPDATE messages SET path = ? WHERE id = ?", (entry.path, row[0])
+            )
+            stats.moved += 1
+    _remove_rows(conn, [rowid for rowid, _ in known.values()])
+    stats.removed += len(known)
+
+
+def update_index(conn: sqlite3.Connection, maildir_root: Path) -> IndexStats:
+    stats = IndexStats()
+    stamps = dict(conn.execute("SELECT folder, stamp FROM folders"))
+    seen = set()
+    for folder in iter_folders(maildir_root):
+        rel = folder.relative_to(maildir_root).as_posix()
+        seen.add(rel)
+        stamp = folder_stamp(folder)
+        if stamps.get(rel) == stamp:
+            continue
+        with conn:
+            _update_folder(conn, folder, rel, stats)
+            conn.execute(
+                "INSERT OR REPLACE INTO folders (folder, stamp) VALUES (?, ?)",
+                (rel, stamp),
+            )
+    for rel in set(stamps) - seen:
+        with conn:
+            rowids = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT id FROM messages WHERE folder = ?", (rel,)
+                )
+            ]
+            _remove_rows(conn, rowids)
+            conn.execute("DELETE FROM folders WHERE folder = ?", (rel,))
+            stats.removed += len(rowids)
+    return stats
+
+
+def _resolve(maildir_root: Path, folder: str, uid: str, path: str) -> str | None:
+    if os.path.exists(path):
+        return path
+    for entry in iter_messages(maildir_root / folder):
+        if split_name(entry.name)[0] == uid:
+            return entry.path
+    return None
+
+
+def _quote(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+# Bare words are quoted, so "alice@example.com" or "O'Brien" are searched for
+# rather than parsed as FTS5 syntax. Column filters, AND/OR/NOT, parentheses,
+# quoted phrases and a trailing "*" for prefix matches keep their meaning.
+def fts_query(query: str) -> str:
+    parts = []
+    for match in _QUERY_RE.finditer(query):
+        token = match.group()
+        if not token:
+            continue
+        if match.lastgroup == "paren" or token in _OPERATORS:
+            parts.append(token)
+            continue
+        column, sep, value = token.partition(":")
+        if sep and column.lower() in COLUMNS:
+            prefix = f"{column}:"
+        else:
+            prefix, value = "", token
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            parts.append(prefix + value)
+        elif value.endswith("*") and len(value) > 1:
+            parts.append(prefix + _quote(value[:-1]) + "*")
+        elif value:
+            parts.append(prefix + _quote(value))
+        else:
+            parts.append(prefix)
+    return " ".join(parts)
+
+
+def search(
+    conn: sqlite3.Connection,
+    maildir_root: Path,
+    query: str,
+    account: str | None = None,
+    limit: int = 200,
+) -> list[str]:
+    sql = (
+        "SELECT m.folder, m.uid, m.path FROM messages_fts "
+        "JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH ?"
+    )
+    params: list = [fts_query(query)]
+    if account:
+        # "0" sorts right after "/", so this is a prefix scan on "<account>/".
+        sql += " AND m.folder >= ? AND m.folder < ?"
+        params += [f"{account}/", f"{account}0"]
+    sql += " ORDER BY m.date DESC LIMIT ?"
+    params.append(limit)
+    results = []
+    for folder, uid, path in conn.execute(sql, params):
+        resolved = _resolve(maildir_root, folder, uid, path)
+        if resolved:
+            results.append(resolved)
+    return results
+
+
+def link_results(results: list[str], dest: Path) -> None:
+    for sub in ("cur", "new", "tmp"):
+        (dest / sub).mkdir(parents=True, exist_ok=True)
+    for sub in ("cur", "new"):
+        for entry in os.scandir(dest / sub):
+            if entry.is_symlink():
+                os.unlink(entry.path)
+    for path in results:
+        link = dest / "cur" / os.path.basename(path)
+        if not link.exists():
+            link.symlink_to(path)
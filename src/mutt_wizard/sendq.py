@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import smtplib
+import ssl
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict
+
+from mutt_wizard.config import Account, Paths
+from mutt_wizard.credentials import oauth_token, password, uses_oauth, xoauth2_string
+from mutt_wizard.locks import run_coalesced
+
+MAX_ATTEMPTS = 8
+RETRY_BASE = 60.0
+RETRY_MAX = 3600.0
+SMTP_TIMEOUT = 30.0
+LOOPBACK_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+@dataclass
+class QueuedMessage:
+    id: str
+    account: str
+    sender: str
+    recipients: list[str]
+    queued_at: float
+    attempts: int = 0
+    next_try: float = 0.0
+    error: str = ""
+
+
+@dataclass
+class FlushStats:
+    sent: int = 0
+    deferred: int = 0
+    failed: int = 0
+    errors: list[str] = field(default_factory=list)
+
+
+def _account_dir(paths: Paths, email: str) -> Path:
+    return paths.outbox / email
+
+
+def _private_dir(path: Path) -> None:
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    path.chmod(0o700)
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    # Queued mail, including Bcc recipients, is readable by the owner only.
+    tmp = path.with_name(f".{path.name}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as handle:
+        handle.write(data)
+    os.replace(tmp, path)
+
+
+def _save(directory: Path, message: QueuedMessage) -> None:
+    _write_atomic(
+        directory / f"{message.id}.json",
+        json.dumps(asdict(message), indent=2).encode("utf-8"),
+    )
+
+
+def _load(path: Path) -> QueuedMessage | None:
+    try:
+        return QueuedMessage(**json.loads(path.read_text(encoding="utf-8")))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def log(paths: Paths, line: str) -> None:
+    paths.sendq_log.parent.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    with paths.sendq_log.open("a", encoding="utf-8") as handle:
+        handle.write(f"{stamp} {line}\n")
+
+
+def enqueue(
+    paths: Paths, email: str, sender: str, recipients: list[str], data: bytes
+) -> QueuedMessage:
+    directory = _account_dir(paths, email)
+    _private_dir(paths.outbox)
+    _private_dir(directory)
+    message = QueuedMessage(
+        id=f"{time.time_ns()}.{os.getpid()}",
+        account=email,
+        sender=sender,
+        recipients=recipients,
+        queued_at=time.time(),
+    )
+    # The .eml is written first; a message only exists once its .json does.
+    _write_atomic(directory / f"{message.id}.eml", data)
+    _save(directory, message)
+    return message
+
+
+def _list(directory: Path) -> list[QueuedMessage]:
+    if not directory.is_dir():
+        return []
+    messages = (_load(path) for path in sorted(directory.glob("[!.]*.json")))
+    return [message for message in messages if message is not None]
+
+
+def queued(paths: Paths, email: str) -> list[QueuedMessage]:
+    return _list(_account_dir(paths, email))
+
+
+def failed(paths: Paths, email: str) -> list[QueuedMessage]:
+    return _list(_account_dir(paths, email) / "failed")
+
+
+def queued_accounts(paths: Paths) -> list[str]:
+    if not paths.outbox.is_dir():
+        return []
+    return sorted(
+        entry.name
+        for entry in os.scandir(paths.outbox)
+        if entry.is_dir() and any(Path(entry.path).glob("[!.]*.json"))
+    )
+
+
+def _move(directory: Path, message: QueuedMessage, dest: Path) -> None:
+    _private_dir(dest)
+    os.replace(directory / f"{message.id}.eml", dest / f"{message.id}.eml")
+    _save(dest, message)
+    (directory / f"{message.id}.json").unlink(missing_ok=True)
+
+
+def _remove(directory: Path, message: QueuedMessage) -> None:
+    (directory / f"{message.id}.json").unlink(missing_ok=True)
+    (directory / f"{message.id}.eml").unlink(missing_ok=True)
+
+
+def retry_failed(paths: Paths, email: str) -> int:
+    directory = _account_dir(paths, email)
+    count = 0
+    for message in failed(paths, email):
+        message.attempts = 0
+        message.next_try = 0.0
+        message.error = ""
+        _move(directory / "failed", message, directory)
+        count += 1
+    return count
+
+
+def connect(paths: Paths, account: Account) -> smtplib.SMTP:
+    context = ssl.create_default_context()
+    loopback = account.smtp_host in LOOPBACK_HOSTS
+    if account.smtp_port == 465:
+        smtp: smtplib.SMTP = smtplib.SMTP_SSL(
+            account.smtp_host, account.smtp_port, timeout=SMTP_TIMEOUT, context=context
+        )
+    else:
+        smtp = smtplib.SMTP(account.smtp_host, account.smtp_port, timeout=SMTP_TIMEOUT)
+        smtp.ehlo()
+        if smtp.has_extn("starttls"):
+            smtp.starttls(context=context)
+            smtp.ehlo()
+        elif not loopback:
+            smtp.close()
+            raise smtplib.SMTPNotSupportedError(
+                f"{account.smtp_host} does not offer STARTTLS"
+            )
+    # A local stand-in server may not offer AUTH at all.
+    if loopback and not smtp.has_extn("auth"):
+        return smtp
+    try:
+        if uses_oauth(account):
+            auth_string = xoauth2_string(account.login, oauth_token(paths, account))
+            smtp.auth(
+                "XOAUTH2",
+                lambda challenge=None: auth_string if challenge is None else "",
+                initial_response_ok=True,
+            )
+        else:
+            smtp.login(account.login, password(account))
+    except Exception:
+        smtp.close()
+        raise
+    return smtp
+
+
+def _permanent_auth_error(exc: Exception) -> bool:
+    if isinstance(exc, ImportError):
+        return True
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        return exc.smtp_code >= 500
+    # google.auth's RefreshError: a revoked grant needs `mw oauth login`.
+    return type(exc).__name__ == "RefreshError" and not getattr(
+        exc, "retryable", False
+    )
+
+
+def _defer(
+    paths: Paths,
+    directory: Path,
+    message: QueuedMessage,
+    error: str,
+    stats: FlushStats,
+    now: float,
+    permanent: bool = False,
+) -> None:
+    message.attempts += 1
+    message.error = error
+    if permanent or message.attempts >= MAX_ATTEMPTS:
+        _move(directory, message, directory / "failed")
+        stats.failed += 1
+        stats.errors.append(f"{message.account} {message.id}: {error}")
+        log(paths, f"FAILED {message.account} {message.id}: {error}")
+        return
+    message.next_try = now + min(RETRY_BASE * 2 ** (message.attempts - 1), RETRY_MAX)
+    _save(directory, message)
+    stats.deferred += 1
+    log(paths, f"deferred {message.account} {message.id}: {error}")
+
+
+def _flush_account(
+    paths: Paths, account: Account, stats: FlushStats, now: float
+) -> None:
+    directory = _account_dir(paths, account.email)
+    ready = [m for m in queued(paths, account.email) if m.next_try <= now]
+    if not ready:
+        return
+    try:
+        smtp = connect(paths, account)
+    except Exception as exc:
+        # Token refreshes can fail with any exception type of the Google
+        # libraries; none of them may leave the message unaccounted for.
+        error = f"connect: {type(exc).__name__}: {exc}"
+        permanent = _permanent_auth_error(exc)
+        for message in ready:
+            _defer(paths, directory, message, error, stats, now, permanent)
+        return
+
+    # One authenticated connection carries every ready message for the account.
+    try:
+        for message in ready:
+            try:
+                data = (directory / f"{message.id}.eml").read_bytes()
+                refused = smtp.sendmail(message.sender, message.recipients, data)
+            except smtplib.SMTPRecipientsRefused as exc:
+                codes = [code for code, _ in exc.recipients.values()]
+                _defer(
+                    paths,
+                    directory,
+                    message,
+                    f"recipients refused: {exc.recipients}",
+                    stats,
+                    now,
+                    permanent=all(code >= 500 for code in codes),
+                )
+                continue
+            except smtplib.SMTPResponseException as exc:
+                error = f"{exc.smtp_code} {exc.smtp_error!r}"
+                permanent = exc.smtp_code >= 500
+                _defer(paths, directory, message, error, stats, now, permanent)
+                continue
+            except (OSError, smtplib.SMTPException) as exc:
+                # The connection is gone; the rest wait for the next flush.
+                _defer(paths, directory, message, str(exc), stats, now)
+                return
+            _remove(directory, message)
+            stats.sent += 1
+            log(paths, f"sent {message.account} {message.id}")
+            if refused:
+                error = f"{message.account} {message.id}: refused {refused}"
+                stats.errors.append(error)
+                log(paths, f"FAILED {error}")
+    finally:
+        try:
+            smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            smtp.close()
+
+
+def flush(
+    paths: Paths, accounts: Dict[str, Account], now: float | None = None
+) -> FlushStats:
+    stats = FlushStats()
+    now = time.time() if now is None else now
+    for email in queued_accounts(paths):
+        account = accounts.get(email)
+        if account is None:
+            stats.errors.append(f"{email}: account not configured")
+            continue
+        _flush_account(paths, account, stats, now)
+    return stats
+
+
+def run_flusher(paths: Paths, accounts: Dict[str, Account]) -> None:
+    # Only one flusher stays behind to retry deferred mail; others flush once.
+    paths.locks_dir.mkdir(parents=True, exist_ok=True)
+    with open(paths.locks_dir / "sendq-retry.lock", "a") as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            retrying = True
+        except BlockingIOError:
+            retrying = False
+        while True:
+            run_coalesced(
+                paths.locks_dir, "sendq", lambda: flush(paths, accounts), wait=False
+            )
+            if not retrying:
+                return
+            pending = [
+                message
+                for email in queued_accounts(paths)
+                if email in accounts
+                for message in queued(paths, email)
+            ]
+            if not pending:
+                return
+            delay = min(message.next_try for message in pending) - time.time()
+            time.sleep(max(1.0, min(delay, RETRY_MAX)))
+
+
+def spawn_flusher(paths: Paths) -> None:
+    paths.sendq_log.parent.mkdir(parents=True, exist_ok=True)
+    with paths.sendq_log.open("a", encoding="utf-8") as log_file:
+        subprocess.Popen(
+            [sys.executable, "-m", "mutt_wizard.cli", "sendq", "--flush"],
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=log_file,
+            start_new_session=True,
+        )
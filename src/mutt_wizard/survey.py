@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import base64
+import imaplib
+import json
+import re
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict
+
+from mutt_wizard.config import Account, Paths, write_json
+from mutt_wizard.credentials import oauth_token, password, uses_oauth, xoauth2_string
+from mutt_wizard.templates import MBSYNC_EXCLUDES
+
+IMAP_TIMEOUT = 30.0
+# Used for folders whose server does not support STATUS=SIZE (RFC 8438).
+ASSUMED_MESSAGE_SIZE = 75 * 1024
+
+_LIST_RE = re.compile(
+    rb'\((?P<flags>[^)]*)\) (?P<delim>"(?:[^"\\]|\\.)*"|NIL) (?P<name>.*)'
+)
+_STATUS_RE = re.compile(rb"([A-Z]+) (\d+)")
+
+
+@dataclass
+class FolderSurvey:
+    name: str
+    messages: int
+    unseen: int
+    size: int | None
+    synced: bool
+
+    @property
+    def estimated_size(self) -> int:
+        if self.size is not None:
+            return self.size
+        return self.messages * ASSUMED_MESSAGE_SIZE
+
+
+@dataclass
+class AccountSurvey:
+    email: str
+    surveyed_at: float
+    folders: list[FolderSurvey] = field(default_factory=list)
+    error: str = ""
+
+    @property
+    def synced_folders(self) -> list[FolderSurvey]:
+        return [folder for folder in self.folders if folder.synced]
+
+    @property
+    def messages(self) -> int:
+        return sum(folder.messages for folder in self.synced_folders)
+
+    @property
+    def size(self) -> int:
+        return sum(folder.estimated_size for folder in self.synced_folders)
+
+    @property
+    def size_is_estimate(self) -> bool:
+        return any(folder.size is None for folder in self.synced_folders)
+
+
+# A name the server encoded wrongly is shown as sent rather than failing the
+# account (binascii.Error and UnicodeDecodeError are both ValueErrors).
+def _decode_mutf7(name: str) -> str:
+    parts = re.split(r"&([^-]*)-", name)
+    decoded = []
+    for index, part in enumerate(parts):
+        if index % 2 == 0:
+            decoded.append(part)
+        elif not part:
+            decoded.append("&")
+        else:
+            data = part.replace(",", "/")
+            data += "=" * (-len(data) % 4)
+            try:
+                decoded.append(base64.b64decode(data).decode("utf-16-be"))
+            except ValueError:
+                return name
+    return "".join(decoded)
+
+
+# mbsync patterns only know "*" and "%" (which stops at the hierarchy delimiter).
+def _excluded(name: str) -> bool:
+    for pattern in MBSYNC_EXCLUDES:
+        regex = re.escape(pattern).replace(r"\*", ".*").replace("%", "[^/]*")
+        if re.fullmatch(regex, name):
+            return True
+    return False
+
+
+def _unquote(value: bytes) -> str:
+    text = value.decode("utf-8", errors="replace").strip()
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        text = re.sub(r"\\(.)", r"\1", text[1:-1])
+    return text
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _list_folders(imap: imaplib.IMAP4) -> list[tuple[str, bool]]:
+    status, data = imap.list()
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"LIST failed: {data}")
+    folders = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            line, name = item[0], item[1].decode("utf-8", errors="replace")
+        else:
+            line, name = item, ""
+        match = _LIST_RE.match(line)
+        if not match:
+            continue
+        if not name:
+            name = _unquote(match.group("name"))
+        selectable = b"\\noselect" not in match.group("flags").lower()
+        folders.append((name, selectable))
+    return folders
+
+
+def _status(imap: imaplib.IMAP4, name: str, with_size: bool) -> Dict[str, int]:
+    items = "(MESSAGES UNSEEN SIZE)" if with_size else "(MESSAGES UNSEEN)"
+    status, data = imap.status(_quote(name), items)
+    if status != "OK" or not data or data[0] is None:
+        raise imaplib.IMAP4.error(f"STATUS {name} failed")
+    line = data[0][-1] if isinstance(data[0], tuple) else data[0]
+    attributes = line[line.rfind(b"(") :]
+    return {key.decode(): int(value) for key, value in _STATUS_RE.findall(attributes)}
+
+
+def _login(paths: Paths, account: Account) -> imaplib.IMAP4:
+    context = ssl.create_default_context()
+    imap = imaplib.IMAP4_SSL(
+        account.imap_host,
+        account.imap_port,
+        ssl_context=context,
+        timeout=IMAP_TIMEOUT,
+    )
+    try:
+        if uses_oauth(account):
+            auth_string = xoauth2_string(account.login, oauth_token(paths, account))
+            imap.authenticate("XOAUTH2", lambda _: auth_string.encode("utf-8"))
+        else:
+            imap.login(account.login, password(account))
+    except Exception:
+        imap.shutdown()
+        raise
+    return imap
+
+
+def survey_account(paths: Paths, account: Account) -> AccountSurvey:
+    result = AccountSurvey(email=account.email, surveyed_at=time.time())
+    try:
+        imap = _login(paths, account)
+    except Exception as exc:
+        # Token refresh errors from the Google libraries, or the libraries
+        # missing, stay with this account instead of failing the survey.
+        result.error = f"{type(exc).__name__}: {exc}"
+        return result
+    try:
+        with_size = "STATUS=SIZE" in imap.capabilities
+        for raw_name, selectable in _list_folders(imap):
+            if not selectable:
+                continue
+            name = _decode_mutf7(raw_name)
+            counts = _status(imap, raw_name, with_size)
+            result.folders.append(
+                FolderSurvey(
+                    name=name,
+                    messages=counts.get("MESSAGES", 0),
+                    unseen=counts.get("UNSEEN", 0),
+                    size=counts.get("SIZE") if with_size else None,
+                    synced=not _excluded(name),
+                )
+            )
+    except (OSError, ValueError, imaplib.IMAP4.error) as exc:
+        result.error = str(exc)
+    finally:
+        try:
+            imap.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+    return result
+
+
+def survey(paths: Paths, accounts: list[Account]) -> list[AccountSurvey]:
+    if not accounts:
+        return []
+    with ThreadPoolExecutor(max_workers=min(8, len(accounts))) as pool:
+        return list(pool.map(lambda account: survey_account(paths, account), accounts))
+
+
+def save_survey(paths: Paths, results: list[AccountSurvey]) -> None:
+    cached = {item.email: item for item in load_survey(paths)}
+    cached.update({item.email: item for item in results if not item.error})
+    write_json(paths.survey_cache, [asdict(item) for item in cached.values()])
+
+
+def load_survey(paths: Paths) -> list[AccountSurvey]:
+    try:
+        data = json.loads(paths.survey_cache.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return []
+    results = []
+    for item in data:
+        folders = [FolderSurvey(**folder) for folder in item.pop("folders", [])]
+        results.append(AccountSurvey(folders=folders, **item))
+    return results
+
+
+# Longest-processing-time-first: hand the biggest remaining account to the lane
+# with the least work so far.
+def plan_lanes(results: list[AccountSurvey], lanes: int) -> list[list[AccountSurvey]]:
+    plan: list[list[AccountSurvey]] = [[] for _ in range(max(1, lanes))]
+    loads = [0] * len(plan)
+    for item in sorted(results, key=lambda item: item.size, reverse=True):
+        index = loads.index(min(loads))
+        plan[index].append(item)
+        loads[index] += item.size
+    return [lane for lane in plan if lane]
+
+
+def transfer_seconds(size: int, bandwidth_mbit: float) -> float:
+    return size * 8 / (bandwidth_mbit * 1_000_000)
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h{minutes % 60:02d}m"
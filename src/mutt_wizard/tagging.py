@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import subprocess
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict
+from urllib.parse import unquote
+
+NEW_TAG = "new"
+
+
+@dataclass
+class TagRule:
+    tags: list[str]
+    query: str
+    line: int
+
+
+def load_rules(path: Path) -> list[TagRule]:
+    rules = []
+    for lineno, raw in enumerate(path.read_text(encoding="utf-8").splitlines(), 1):
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        if " -- " not in f" {line} ":
+            raise ValueError(f"{path}:{lineno}: expected '+tag -tag -- query'")
+        ops, _, query = f" {line} ".partition(" -- ")
+        tags = ops.split()
+        query = query.strip()
+        if not tags or not query:
+            raise ValueError(f"{path}:{lineno}: expected '+tag -tag -- query'")
+        for tag in tags:
+            if len(tag) < 2 or tag[0] not in "+-":
+                raise ValueError(f"{path}:{lineno}: invalid tag operation {tag!r}")
+        rules.append(TagRule(tags=tags, query=query, line=lineno))
+    return rules
+
+
+# Without "new" in new.tags, every rule matches nothing and the final untag is
+# a no-op, so the rules would silently never apply.
+def new_tag_configured(env: Dict[str, str] | None = None) -> bool:
+    result = subprocess.run(
+        ["notmuch", "config", "get", "new.tags"],
+        capture_output=True,
+        text=True,
+        check=False,
+        env=env,
+    )
+    tags = result.stdout.replace(";", "\n").split()
+    return result.returncode == 0 and NEW_TAG in tags
+
+
+# Rules are written in the batch format, where tags are hex-encoded
+# ("+foo%20bar"); on the command line notmuch takes them literally.
+def _decode_tag(op: str) -> str:
+    return op[0] + unquote(op[1:])
+
+
+def _rule_query(rule: TagRule) -> str:
+    return f"tag:{NEW_TAG} and ({rule.query})"
+
+
+def batch_input(rules: list[TagRule]) -> str:
+    lines = [f"{' '.join(rule.tags)} -- {_rule_query(rule)}" for rule in rules]
+    lines.append(f"-{NEW_TAG} -- tag:{NEW_TAG}")
+    return "\n".join(lines) + "\n"
+
+
+def apply_rules(rules: list[TagRule], env: Dict[str, str] | None = None) -> float:
+    start = time.monotonic()
+    result = subprocess.run(
+        ["notmuch", "tag", "--batch"],
+        input=batch_input(rules),
+        text=True,
+        check=False,
+        env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"notmuch tag --batch exited with {result.returncode}")
+    return time.monotonic() - start
+
+
+def profile_rules(
+    rules: list[TagRule], env: Dict[str, str] | None = None
+) -> list[tuple[TagRule, int, float]]:
+    timings = []
+    for rule in rules:
+        query = _rule_query(rule)
+        start = time.monotonic()
+        count = subprocess.run(
+            ["notmuch", "count", query],
+            capture_output=True,
+            text=True,
+            check=False,
+            env=env,
+        )
+        subprocess.run(
+            ["notmuch", "tag", *map(_decode_tag, rule.tags), "--", query],
+            check=False,
+            env=env,
+        )
+        matched = int(count.stdout.strip() or 0) if count.returncode == 0 else 0
+        timings.append((rule, matched, time.monotonic() - start))
+    subprocess.run(
+        ["notmuch", "tag", f"-{NEW_TAG}", "--", f"tag:{NEW_TAG}"], check=False, env=env
+    )
+    return timings
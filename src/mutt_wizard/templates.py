@@ -2,6 +2,8 @@ from __future__ import annotations
 
 from mutt_wizard.config import Account, Paths
 
+MBSYNC_EXCLUDES = ["[Gmail]/All Mail", "*fts-flatcurve*", "*virtual*"]
+
 SWITCH_MUTTRC = """\
 # vim: filetype=neomuttrc
 # Unbind per-account settings before switching accounts.
@@ -28,6 +30,9 @@ set mail_check=60
 
 bind index i noop
 bind pager i noop
+set query_command = "mw contacts '%s'"
+bind editor <Tab> complete-query
+macro index \\Cf "<enter-command>unset wait_key<enter><shell-escape>mw search --link --prompt<enter><change-folder>{search_results}<enter>" "search mail index"
 """
 
 MAILCAP_TEMPLATE = """\
@@ -59,7 +64,9 @@ find \"${tempdir:?}\" -mtime +1 -type f -delete
 
 def render_base_muttrc(paths: Paths) -> str:
     mailcap_path = f"{paths.mutt_config / 'mailcap'}:{paths.mailcap}:$mailcap_path"
-    return BASE_MUTTRC_TEMPLATE.format(mailcap_path=mailcap_path)
+    return BASE_MUTTRC_TEMPLATE.format(
+        mailcap_path=mailcap_path, search_results=paths.search_results
+    )
 
 
 def render_mailcap(paths: Paths) -> str:
@@ -95,6 +102,17 @@ def render_account_muttrc(account: Account, paths: Paths) -> str:
         record = "+Sent"
 
     mailboxes = " ".join(f'"={box}"' for box in mailboxes_for_account(account))
+    if account.send_queue:
+        sendmail = f"mw sendq -a {account.email}"
+    else:
+        sendmail = f"msmtp -C {paths.msmtp_config} -a {account.email}"
+    fetch_macros = []
+    if account.max_size:
+        fetch_macros.append(
+            f"macro index,pager \\ef \"<set-flag>!<sync-mailbox>"
+            f"<shell-escape>mw fetch {account.email}<enter>\" "
+            f'"fetch oversized message in full"'
+        )
 
     return "\n".join(
         [
@@ -102,7 +120,7 @@ def render_account_muttrc(account: Account, paths: Paths) -> str:
             f"# muttrc file for account {account.email}",
             f'set real_name = "{account.realname}"',
             f'set from = "{account.email}"',
-            f'set sendmail = "msmtp -C {paths.msmtp_config} -a {account.email}"',
+            f'set sendmail = "{sendmail}"',
             f"alias me {account.realname} <{account.email}>",
             f'set folder = "{folder}"',
             f'set header_cache = "{cache_dir / "headers"}"',
@@ -115,7 +133,9 @@ def render_account_muttrc(account: Account, paths: Paths) -> str:
             f'set trash = "{trash}"',
             f'set record = "{record}"',
             f"mailboxes {mailboxes}",
-            f'macro index o "<shell-escape>mailsync {account.email}<enter>" "sync {account.email}"',
+            f'macro index o "<shell-escape>mailsync --full-priority '
+            f'{account.email}<enter>" "sync {account.email}"',
+            *fetch_macros,
             "",
         ]
     )
@@ -145,12 +165,13 @@ def render_mbsync(
             "Subfolders Verbatim",
             f"Path {paths.maildir_root / account.email}/",
             f"Inbox {paths.maildir_root / account.email}/INBOX",
+            *([f"MaxSize {account.max_size}"] if account.max_size else []),
             "",
             f"Channel {account.email}",
             "Expunge Both",
             f"Far :{account.email}-remote:",
             f"Near :{account.email}-local:",
-            'Patterns * !"[Gmail]/All Mail" !"*fts-flatcurve*" !"*virtual*"',
+            "Patterns * " + " ".join(f'!"{box}"' for box in MBSYNC_EXCLUDES),
             "Create Both",
             "SyncState *",
             f"MaxMessages {max_messages}",